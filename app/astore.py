@@ -0,0 +1,68 @@
+import asyncio, os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from app.batcher import WRITE_DELAY_MS, WriteBatcher
+
+# мелкие записи из хендлеров -> групповой коммит; пакетные (advance_targets, import_rows,
+# start_surveys, save_surveys) и так одной транзакцией и идут напрямую
+BATCHED = frozenset(("upsert_user", "set_tz", "set_active", "update_targets_after_day", "add_points_and_streak",
+                     "finalize_day", "upsert_log", "put_survey_state", "set_survey_value", "clear_survey"))
+
+# async-обёртка над синхронным app.db: запросы уходят в отдельные потоки,
+# event loop бота не ждёт диск. Реализует app.storage.Store для SQLite
+class AsyncStore:
+    def __init__(self, backend, threads: int = None):
+        self._backend = backend
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads or int(os.getenv("DB_THREADS", "4")),
+            thread_name_prefix="store",
+        )
+        pool = getattr(backend, "pool", None)
+        self._batcher = WriteBatcher(pool, self._executor) if WRITE_DELAY_MS and pool is not None else None
+        if self._batcher is not None:
+            pool.set_synchronous("FULL")  # fsync раз на пачку: подтверждённая запись переживёт и сбой ОС
+
+    def __getattr__(self, name):
+        fn = getattr(self._backend, name)
+        if not callable(fn) or name.startswith("_"):
+            return fn
+
+        if self._batcher is not None and name in BATCHED:
+            async def call(*args, **kwargs):
+                return await self._batcher.submit(fn, *args, **kwargs)
+        else:
+            async def call(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+        call.__name__ = name
+        setattr(self, name, call)  # кешируем обёртку, __getattr__ больше не дёргается
+        return call
+
+    async def iterate(self, name: str, *args, **kwargs):
+        # синхронный генератор app.db -> async-итератор: каждый next() в executor
+        loop = asyncio.get_running_loop()
+        gen = getattr(self._backend, name)(*args, **kwargs)
+        done = object()
+        while True:
+            item = await loop.run_in_executor(self._executor, next, gen, done)
+            if item is done:
+                return
+            yield item
+
+    def iter_active_users(self, *args, **kwargs):
+        return self.iterate("iter_active_users", *args, **kwargs)
+
+    def iter_rows(self, *args, **kwargs):
+        return self.iterate("iter_rows", *args, **kwargs)
+
+    def cache_stats(self) -> dict:
+        return self._backend.user_cache.stats()
+
+    async def close(self):
+        if self._batcher is not None:
+            await self._batcher.close()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._backend.close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,124 @@
+import argparse, glob, os, sqlite3, sys, time
+from datetime import datetime, timezone
+
+# онлайн-бэкап SQLite: backup API шагами по BACKUP_PAGES страниц из отдельного соединения.
+# На источнике держим читающую транзакцию -> снимок согласован и копирование не перезапускается
+# от чужих коммитов; в WAL писатели при этом не ждут. Бот зовёт это из джобы в фоновом потоке.
+#   python -m app.backup now             # снимок в BACKUP_DIR + ротация
+#   python -m app.backup list
+#   python -m app.backup restore FILE    # при остановленном боте
+BACKUP_DIR = os.getenv("BACKUP_DIR", "data/backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_EVERY_MIN = float(os.getenv("BACKUP_EVERY_MIN", "360"))  # 0 -> без фоновых бэкапов
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))
+BACKUP_PAUSE_MS = float(os.getenv("BACKUP_PAUSE_MS", "2"))  # пауза между шагами, дросселирует IO
+PREFIX = "bot-"
+
+
+def snapshot(src_path: str, dst_path: str, pages: int = BACKUP_PAGES, pause_ms: float = BACKUP_PAUSE_MS) -> dict:
+    part = dst_path + ".part"
+    if os.path.exists(part):
+        os.remove(part)
+    src = sqlite3.connect(src_path, isolation_level=None)
+    dst = sqlite3.connect(part)
+    steps, longest = 0, 0.0
+    last = t0 = time.perf_counter()
+
+    def progress(status, remaining, total):
+        nonlocal steps, longest, last
+        now = time.perf_counter()
+        steps += 1
+        longest = max(longest, now - last)  # один шаг = одна порция страниц под локом pager'а
+        if pause_ms and remaining:
+            time.sleep(pause_ms / 1000)
+        last = time.perf_counter()
+
+    try:
+        src.execute("PRAGMA query_only=1")
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()  # фиксируем снимок
+        src.backup(dst, pages=pages, progress=progress)
+        src.execute("COMMIT")
+        # копия — один самодостаточный файл, без -wal/-shm рядом
+        dst.execute("PRAGMA journal_mode=DELETE")
+        page_size = dst.execute("PRAGMA page_size").fetchone()[0]
+        n_pages = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    os.replace(part, dst_path)
+    dt = time.perf_counter() - t0
+    size = page_size * n_pages
+    return {"path": dst_path, "bytes": size, "pages": n_pages, "steps": steps, "seconds": round(dt, 3),
+            "mb_per_s": round(size / dt / 2**20, 1) if dt else 0.0,
+            "max_step_ms": round(longest * 1000, 2), "snapshot_held_s": round(dt, 3)}
+
+
+def backups(directory: str = BACKUP_DIR) -> list:
+    # старые -> новые (имя содержит UTC-время)
+    return sorted(glob.glob(os.path.join(directory, PREFIX + "*.db")))
+
+
+def rotate(directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> list:
+    old = backups(directory)[:-keep] if keep > 0 else []
+    for p in old:
+        os.remove(p)
+    return old
+
+
+def run(db_path: str, directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP, **kw) -> dict:
+    os.makedirs(directory, exist_ok=True)
+    name = PREFIX + datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S-%f")[:-3] + ".db"
+    st = snapshot(db_path, os.path.join(directory, name), **kw)
+    st["rotated"] = len(rotate(directory, keep))
+    return st
+
+
+def restore(backup_path: str, db_path: str, directory: str = BACKUP_DIR) -> dict:
+    # бот должен быть остановлен. Проверяем файл, текущую базу сохраняем рядом, потом
+    # заливаем бэкап через тот же backup API (корректно для WAL, без ручного копирования файлов)
+    con = sqlite3.connect(f"file:{backup_path}?mode=ro", uri=True)
+    try:
+        ok = con.execute("PRAGMA integrity_check").fetchone()[0]
+        if ok != "ok":
+            raise SystemExit(f"{backup_path}: integrity_check failed: {ok}")
+        saved = None
+        if os.path.exists(db_path):
+            os.makedirs(directory, exist_ok=True)
+            saved = os.path.join(directory, "pre-restore-" + datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S") + ".db")
+            snapshot(db_path, saved, pause_ms=0)
+        dst = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            t = time.perf_counter()
+            con.backup(dst, pages=0)
+            dst.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            dt = time.perf_counter() - t
+        finally:
+            dst.close()
+    finally:
+        con.close()
+    return {"restored": backup_path, "into": db_path, "previous": saved, "seconds": round(dt, 3)}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="app.backup")
+    p.add_argument("cmd", choices=("now", "list", "restore"))
+    p.add_argument("file", nargs="?", help="для restore: файл бэкапа")
+    p.add_argument("--db", default=os.getenv("DB_PATH", "data/bot.db"))
+    p.add_argument("--dir", default=BACKUP_DIR)
+    p.add_argument("--keep", type=int, default=BACKUP_KEEP)
+    args = p.parse_args(argv)
+    if args.cmd == "now":
+        print(run(args.db, args.dir, args.keep))
+    elif args.cmd == "list":
+        for b in backups(args.dir):
+            print(f"{b}\t{os.path.getsize(b)}")
+    else:
+        if not args.file:
+            p.error("restore: укажи файл бэкапа")
+        print(restore(args.file, args.db, args.dir))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
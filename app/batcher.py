@@ -0,0 +1,91 @@
+import asyncio, os
+from typing import Callable, List, Tuple
+
+from app import metrics
+
+# групповой коммит для SQLite: мелкие записи из параллельных хендлеров копятся и уходят одной
+# транзакцией писателя (каждая — в своём SAVEPOINT, ошибка одной не откатывает соседей).
+# Пачка закрывается по размеру WRITE_BATCH или через WRITE_DELAY_MS; пока идёт коммит,
+# следующая пачка набирается сама. Вызывающий получает результат только после COMMIT, а писатель
+# при групповом коммите работает с synchronous=FULL (см. AsyncStore) -> ответ == запись на диске;
+# цена — один fsync на пачку, а не на операцию.
+WRITE_BATCH = int(os.getenv("WRITE_BATCH", "128"))
+WRITE_DELAY_MS = float(os.getenv("WRITE_DELAY_MS", "2"))  # 0 -> без группового коммита
+
+BATCH_OPS = metrics.REGISTRY.histogram("bot_write_batch_ops", "Операций в одном групповом коммите",
+                                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+
+class WriteBatcher:
+    def __init__(self, pool, executor, max_batch: int = WRITE_BATCH, max_delay: float = WRITE_DELAY_MS / 1000):
+        self.pool = pool
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending: List[Tuple[Callable, tuple, dict, asyncio.Future]] = []
+        self._timer = None
+        self._flushing = False
+
+    async def submit(self, fn: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((fn, args, kwargs, fut))
+        if self._flushing:
+            pass  # заберёт текущий flush, когда закоммитит свою пачку
+        elif len(self._pending) >= self.max_batch:
+            self._start(loop)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start, loop)
+        return await fut
+
+    def _start(self, loop):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._flushing and self._pending:
+            self._flushing = True
+            loop.create_task(self._flush(loop))
+
+    async def _flush(self, loop):
+        try:
+            while self._pending:
+                ops, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                BATCH_OPS.observe(len(ops))
+                try:
+                    results = await loop.run_in_executor(self.executor, self._commit, [op[:3] for op in ops])
+                except asyncio.CancelledError:
+                    # остановка: ждущим — отмена, а не «ошибка записи» (пачка в потоке может и закоммититься),
+                    # сама отмена летит дальше
+                    for *_, fut in ops + self._pending:
+                        fut.cancel()
+                    self._pending = []
+                    raise
+                except Exception as e:
+                    results = [(False, e)] * len(ops)  # COMMIT не прошёл -> ошибка всем
+                for (_, _, _, fut), (ok, value) in zip(ops, results):
+                    if fut.done():
+                        continue  # вызывающего отменили
+                    if ok:
+                        fut.set_result(value)
+                    else:
+                        fut.set_exception(value)
+        finally:
+            self._flushing = False
+
+    def _commit(self, ops) -> List[Tuple[bool, object]]:
+        results = []
+        with self.pool.write():
+            for fn, args, kwargs in ops:
+                try:
+                    with self.pool.write():  # SAVEPOINT
+                        results.append((True, fn(*args, **kwargs)))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+
+    async def close(self):
+        # дождаться хвоста перед закрытием пула
+        if self._pending:
+            self._start(asyncio.get_running_loop())
+        while self._flushing:
+            await asyncio.sleep(0.001)
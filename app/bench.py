@@ -0,0 +1,291 @@
+import argparse, asyncio, json, os, random, resource, signal, subprocess, sys, tempfile, time
+import urllib.request
+from datetime import date, datetime, timedelta, timezone
+
+# нагрузочный прогон бота против фейкового Bot API (app.fakeapi, отдельным процессом), без Telegram и сети:
+# N юзеров через upsert_user, затем полные дни — утренняя рассылка, вечерний опрос из шести
+# ответов через text_handler (или кнопками, --buttons), finalize_day. Результаты дописываются в BENCH_RESULTS (jsonl)
+# и сравниваются с прошлым прогоном тех же параметров.
+# --startup: холодный старт python -m app.bot на базе из N юзеров с открытыми опросами —
+# время до первого обработанного апдейта и фазы из --profile-startup.
+#   python -m app.bench --users 1000 10000 100000 --days 2
+#   python -m app.bench --startup --users 10000 100000
+BENCH_RESULTS = os.getenv("BENCH_RESULTS", "bench/results.jsonl")
+ZONES = ["Europe/Amsterdam", "Europe/Moscow", "America/New_York", "Asia/Tokyo"]
+D0 = date(2024, 1, 1)
+
+
+def pct(xs, q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+def answers(rnd: random.Random):
+    screen = rnd.randint(60, 300)
+    return [str(rnd.randint(0, 90)), str(rnd.randint(0, 240)), str(screen), str(rnd.randint(0, screen)),
+            f"0{rnd.randint(6, 8)}:{rnd.randint(0, 59):02d}", f"23:{rnd.randint(0, 59):02d}"]
+
+
+def taps(rnd: random.Random, steps, d: str):
+    # callback_data нажатий по шагам опроса; Telegram не больше экрана
+    screen = rnd.choice(steps[2][3])
+    vals = [rnd.choice(steps[0][3]), rnd.choice(steps[1][3]), screen,
+            rnd.choice([v for v in steps[3][3] if v <= screen]), rnd.choice(steps[4][3]), rnd.choice(steps[5][3])]
+    return [f"sv:{d}:{i}:{v}" for i, v in enumerate(vals)]
+
+
+class FakeApi:
+    # app.fakeapi отдельным процессом: его CPU, GIL и память не попадают в задержки и RSS бота
+    def __init__(self, latency_ms: float):
+        self.proc = subprocess.Popen([sys.executable, "-m", "app.fakeapi", "--port", "0",
+                                      "--latency-ms", str(latency_ms)], stdout=subprocess.PIPE, text=True)
+        self.url = self.proc.stdout.readline().strip()
+        if not self.url:
+            raise SystemExit(f"app.fakeapi exited with {self.proc.wait()}")
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(self.url + "/stats") as r:
+            return json.load(r)
+
+    def push(self, update: dict):
+        req = urllib.request.Request(self.url + "/updates", data=json.dumps(update).encode(),
+                                     headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(req).close()
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGTERM)
+        self.proc.wait(timeout=10)
+
+
+async def drain(outbox):
+    while outbox.backlog:
+        await asyncio.sleep(0.005)
+
+
+async def run(args) -> dict:
+    api = FakeApi(args.api_latency_ms)
+
+    # всё, что app.bot читает из окружения при импорте
+    os.environ.update(BOT_TOKEN="1:bench", BOT_API_URL=api.url, METRICS_PORT="",
+                      BROADCAST_RATE=str(args.rate), SURVEY_BUTTONS="1" if args.buttons else "0")
+    if not os.getenv("DATABASE_URL"):
+        os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bot.db")
+    from telegram import Update
+    from telegram.ext import CallbackContext
+    from app import bot
+    from app.config import initial_targets
+    from app.webhook import fake_callback, fake_update
+
+    app = bot.build_app()
+    for job in app.job_queue.get_jobs_by_name("slots"):
+        job.schedule_removal()  # слоты дёргаем сами, по «виртуальным» дням
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    store, outbox = bot.store, app.bot_data["outbox"]
+    pool = getattr(store, "_backend", None) and store._backend.pool
+    res = {"users": args.users, "days": args.days, "concurrency": args.concurrency,
+           "api_latency_ms": args.api_latency_ms, "backend": "postgres" if pool is None else "sqlite",
+           "survey": "buttons" if args.buttons else "text"}
+
+    t = initial_targets()
+    targets = {"reading": t.reading, "focus": t.focus, "screen": t.screen, "tg": t.tg,
+               "wake": t.wake_min, "sleep": t.sleep_min}
+    deltas = {"reading": t.d_reading, "focus": t.d_focus, "screen": t.d_screen, "tg": t.d_tg,
+              "wake": t.d_wake, "sleep": t.d_sleep}
+    t0 = time.perf_counter()
+    for i in range(1, args.users + 1, 256):
+        await asyncio.gather(*(store.upsert_user(c, ZONES[c % len(ZONES)], targets, deltas, D0.isoformat())
+                               for c in range(i, min(i + 256, args.users + 1))))
+    res["seed_s"] = round(time.perf_counter() - t0, 2)
+
+    rnd = random.Random(1)
+    ctx = CallbackContext(app)
+    zones = await store.active_zones()
+    update_id = 0
+    lat, fin = [], []
+    morning_s = evening_s = survey_s = 0.0
+    commits = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def user_day(chat_id: int, texts):
+        nonlocal update_id
+        async with sem:
+            for step, text in enumerate(texts):
+                update_id += 1
+                raw = (fake_callback(chat_id, text, update_id, update_id) if args.buttons
+                       else fake_update(chat_id, text, update_id))
+                upd = Update.de_json(raw, app.bot)
+                s = time.perf_counter()
+                await app.process_update(upd)
+                (fin if step == len(texts) - 1 else lat).append(time.perf_counter() - s)
+
+    for day in range(args.days):
+        d = D0 + timedelta(days=day + 1)
+        c0 = pool.commits if pool else 0
+
+        s = time.perf_counter()
+        await bot.morning_job(ctx, zones, d)
+        await drain(outbox)
+        morning_s += time.perf_counter() - s
+
+        s = time.perf_counter()
+        await bot.evening_job(ctx, zones, d)
+        await drain(outbox)
+        evening_s += time.perf_counter() - s
+
+        s = time.perf_counter()
+        await asyncio.gather(*(user_day(c, taps(rnd, bot.SURVEY_STEPS, d.isoformat()) if args.buttons
+                                        else answers(rnd)) for c in range(1, args.users + 1)))
+        await bot.flush_surveys()
+        await drain(outbox)
+        survey_s += time.perf_counter() - s
+        commits += (pool.commits - c0) if pool else 0
+
+    n = args.users * args.days
+    api_calls = sum(api.stats()["calls"].values())
+    res.update({
+        "morning_msgs_per_s": round(n / morning_s, 1),
+        "evening_msgs_per_s": round(n / evening_s, 1),
+        "updates_per_s": round(n * 6 / survey_s, 1),
+        "answer_p50_ms": round(pct(lat, .5) * 1000, 3),
+        "answer_p99_ms": round(pct(lat, .99) * 1000, 3),
+        "finalize_p50_ms": round(pct(fin, .5) * 1000, 3),
+        "finalize_p99_ms": round(pct(fin, .99) * 1000, 3),
+        "commits_per_s": round(commits / (morning_s + evening_s + survey_s), 1),
+        "commits_per_user_day": round(commits / n, 2),
+        "api_calls": api_calls,
+        "api_calls_per_user_day": round(api_calls / n, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    api.stop()
+    return res
+
+
+def seed(path: str, users: int):
+    # N юзеров, у всех открыт сегодняшний вечерний опрос, чётные уже ответили на два вопроса
+    # (шаг 2): падение посреди вечера — худший случай для старта, эти опросы бот переспросит
+    os.environ["DB_PATH"] = path
+    from app import db
+    from app.config import initial_targets
+    t = initial_targets()
+    targets = {"reading": t.reading, "focus": t.focus, "screen": t.screen, "tg": t.tg,
+               "wake": t.wake_min, "sleep": t.sleep_min}
+    deltas = {"reading": t.d_reading, "focus": t.d_focus, "screen": t.d_screen, "tg": t.d_tg,
+              "wake": t.d_wake, "sleep": t.d_sleep}
+    db.init_db()
+    with db.pool.write():
+        for c in range(1, users + 1):
+            db.upsert_user(c, ZONES[c % len(ZONES)], targets, deltas, D0.isoformat())
+        today = datetime.now(timezone.utc).date().isoformat()
+        db.start_surveys(list(range(1, users + 1)), today)
+        db.save_surveys([(2, 20, 30, None, None, None, None, c, today) for c in range(2, users + 1, 2)])
+    db.close()
+
+
+def run_startup(args) -> dict:
+    from app.webhook import fake_update
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    path = os.path.join(tmp, "bot.db")
+    s = time.perf_counter()
+    seed(path, args.users)
+    res = {"mode": "startup", "users": args.users, "seed_s": round(time.perf_counter() - s, 2)}
+
+    api = FakeApi(args.api_latency_ms)
+    api.push(fake_update(1, "/goals", 1))  # первый апдейт ждёт бота в getUpdates
+    env = dict(os.environ, BOT_TOKEN="1:bench", BOT_API_URL=api.url, DB_PATH=path, METRICS_PORT="",
+               BACKUP_EVERY_MIN="0")
+    err = os.path.join(tmp, "bot.stderr")
+    with open(err, "w") as f:
+        t0 = time.monotonic()  # те же часы, что first_at у фейка в другом процессе
+        proc = subprocess.Popen([sys.executable, "-m", "app.bot", "--profile-startup"], env=env, stderr=f)
+    try:
+        # бот пишет фазы при первом апдейте и после фонового прогрева — ждём обе строки
+        profile, first_at = {}, {}
+        # ответ именно на /goals чата 1: переспрошенные опросы тоже идут sendMessage
+        while "warm" not in profile or "first_update" not in profile or "sendMessage@1" not in first_at:
+            if proc.poll() is not None:
+                raise SystemExit(f"app.bot exited with {proc.returncode}, see {err}")
+            time.sleep(0.005)
+            if "sendMessage@1" not in first_at:
+                first_at = api.stats()["first_at"]
+            with open(err) as f:
+                for line in f:
+                    if line.startswith("startup {"):
+                        profile.update(json.loads(line[8:]))
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(timeout=60)
+        api.stop()
+    res["first_update_s"] = round(first_at["sendMessage@1"] - t0, 3)  # от запуска процесса до ответа
+    # фазы — секунды (float), остальное — счётчики (surveys_loaded, surveys_asked_again)
+    res.update({f"bot_{k}_s" if isinstance(v, float) else k: v for k, v in profile.items()})
+    return res
+
+
+def rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def save(res: dict, path: str = BENCH_RESULTS):
+    # прошлый прогон с теми же параметрами -> разница в процентах
+    same = ("mode", "users", "days", "concurrency", "api_latency_ms", "backend", "survey")
+    prev = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                if all(r.get(k) == res.get(k) for k in same):
+                    prev = r
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(res, ensure_ascii=False) + "\n")
+    for k, v in res.items():
+        if k in same or not isinstance(v, (int, float)):
+            continue
+        was = prev.get(k) if prev else None
+        diff = f"  ({(v - was) / was * 100:+.1f}% vs {prev['rev'] or prev['at']})" if was else ""
+        print(f"{k:>22}: {v}{diff}")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="app.bench")
+    p.add_argument("--users", type=int, nargs="+", default=[1000])
+    p.add_argument("--days", type=int, default=1)
+    p.add_argument("--concurrency", type=int, default=256, help="юзеров, отвечающих одновременно")
+    p.add_argument("--api-latency-ms", type=float, default=0.0)
+    p.add_argument("--rate", type=float, default=1e6, help="BROADCAST_RATE; у фейкового API лимита нет")
+    p.add_argument("--buttons", action="store_true", help="опрос инлайн-кнопками (SURVEY_BUTTONS=1)")
+    p.add_argument("--startup", action="store_true", help="замерить холодный старт вместо нагрузки")
+    p.add_argument("--out", default=BENCH_RESULTS)
+    args = p.parse_args(argv)
+
+    if len(args.users) > 1:
+        # каждый размер — отдельным процессом: своя база, честный peak RSS
+        rest = [a for a in (argv if argv is not None else sys.argv[1:])]
+        i = rest.index("--users")
+        rest[i:i + 1 + len(args.users)] = []
+        return max(subprocess.run([sys.executable, "-m", "app.bench", "--users", str(n), *rest]).returncode
+                   for n in args.users)
+
+    args.users = args.users[0]
+    res = run_startup(args) if args.startup else asyncio.run(run(args))
+    res = {"at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "rev": rev(), **res}
+    print(f"users={res['users']} " + (f"mode=startup" if args.startup else
+                                      f"days={res['days']} backend={res['backend']}"))
+    save(res, args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,89 @@
-import asyncio
-from datetime import datetime, time, timedelta, date
+from time import perf_counter
+T0 = perf_counter()  # --profile-startup: фазы считаются от начала импорта app.bot
+
+import asyncio, json, logging, sys
+from datetime import datetime, timedelta, date, timezone
 import zoneinfo
 from typing import Dict
 
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+    ApplicationBuilder, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
 )
 
 from app.config import (
     DEFAULT_TZ, initial_targets, minutes_to_hhmm, hhmm_to_minutes,
     MORNING_HH, MORNING_MM, EVENING_HH, EVENING_MM,
     WAKE_TOL_MIN, SLEEP_TOL_MIN, PTS_OK, PTS_FAIL, PTS_ALL_OK_BONUS,
-    DURATION_DAYS, READING_END, FOCUS_END, SCREEN_END, TG_END, WAKE_END, SLEEP_END
+    DURATION_DAYS, READING_END, FOCUS_END, SCREEN_END, TG_END, WAKE_END, SLEEP_END, ladder
 )
-from app import db as store
-import os
+from app.storage import open_store
+from app import broadcast
+from app.broadcast import Broadcaster
+from app.survey import SurveyCache
+from app.shard import Shards, parse_shard
+from app import metrics
+from app.metrics import timed, HANDLER_SECONDS, JOB_LAG, TG_ERRORS, TG_RETRY_AFTER
+from app.httpd import HttpServer
+from app.slots import zone, local_today, due_zones, slot_instant
+from app import webhook
+from app.webhook import ChatOrderedProcessor, WEBHOOK_CONCURRENCY
+import argparse, os, tempfile
+from app.export import dump
+from app import backup
+from app.astore import AsyncStore
+from app.cache import LRU
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
 TZ = zoneinfo.ZoneInfo(DEFAULT_TZ)
 
+FANOUT_BATCH = int(os.getenv("FANOUT_BATCH", "100"))
+TICK_SEC = int(os.getenv("TICK_SEC", "60"))
+SURVEY_FLUSH_SEC = float(os.getenv("SURVEY_FLUSH_SEC", "5"))
+# маркер чистой остановки: on_shutdown уже сбросил опросы в таблицу -> после рестарта переспрашивать нечего
+CLEAN_MARK = os.getenv("CLEAN_MARK", os.path.join(os.path.dirname(os.getenv("DB_PATH", "data/bot.db")) or ".",
+                                                  "clean-shutdown"))
+ZONES_TTL = timedelta(minutes=10)
+# всё, что читает send_goals
+MORNING_COLS = ("active", "tz", "start_date", "reading_target", "focus_target", "screen_target",
+                "tg_target", "wake_target", "sleep_target")
+# /metrics — отдельный порт на loopback в обоих режимах (не на публичном порту вебхука); пусто -> выключено
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT", "9108")
+# вечерний опрос кнопками: одно сообщение правится на месте, ответы копятся в памяти и пишутся
+# одной транзакцией finalize_day. Текстом отвечать по-прежнему можно. Это про удобство, не про нагрузку:
+# коммитов столько же (текстовые шаги и так идут write-behind + групповым коммитом), а вызовов Bot API
+# больше — каждое нажатие это answerCallbackQuery + editMessageText (bench, 300 юзеров: ~14 против 8 на юзеро-день)
+SURVEY_BUTTONS = os.getenv("SURVEY_BUTTONS", "0") == "1"
+MSG_CACHE_SIZE = int(os.getenv("MSG_CACHE_SIZE", "4096"))
+TOP_N = int(os.getenv("TOP_N", "10"))
+STATS_PERIODS = {"week": (7, "За неделю"), "month": (30, "За месяц"), "all": (0, "За всё время")}
+
+log = logging.getLogger(__name__)
+# фазы старта, сек от T0: import, initialize (getMe), init_db, ready (принимаем апдейты),
+# surveys/zones/ranks/warm (фон), first_update
+STARTUP: Dict[str, float] = {"import": round(perf_counter() - T0, 4)}
+
+# все обращения к БД из хендлеров — через executor, не блокируя event loop
+store = open_store()
+# активные опросы живут в памяти, в таблицу survey сбрасываются раз в SURVEY_FLUSH_SEC
+surveys = SurveyCache()
+# шард этого воркера (--shard i/N); по умолчанию один процесс на всех
+shards = Shards()
+metrics.SURVEYS_ACTIVE.set_function(lambda: len(surveys))
+# опросы из таблицы поднимаются в фоне; ответы, пришедшие раньше, ждут только этого
+surveys_ready = asyncio.Event()
+# готовые тексты целей по округлённым целям: юзеры на одной ступени лестницы делят одну строку.
+# Ключ — сами значения, поэтому после update_targets_after_day (get_user уже свежий) юзер просто
+# попадает в другой ключ, устаревших текстов не бывает
+texts = LRU(MSG_CACHE_SIZE)
+
+WAKE_END_MIN = hhmm_to_minutes(WAKE_END)
+SLEEP_END_MIN = hhmm_to_minutes(SLEEP_END)
+
 def clamp_targets(u):
     # ограничиваем по финальным целям (не выходим за пределы)
     u_read = min(u["reading_target"], READING_END)
@@ -28,108 +91,273 @@ def clamp_targets(u):
     u_screen = max(u["screen_target"], SCREEN_END)
     u_tg = max(min(u["tg_target"], u_screen), TG_END)  # tg <= screen, и >= финального
     # время: идём к целевому не позже -> минимумы
-    u_wake = max(u["wake_target"], hhmm_to_minutes(WAKE_END))    # нельзя стать "раньше" цели (числом меньше), поэтому max с целевым?
+    u_wake = max(u["wake_target"], WAKE_END_MIN)    # нельзя стать "раньше" цели (числом меньше), поэтому max с целевым?
     # Время "раньше" это меньше минут => цель конечная = 07:00 (420). Нам нужно min(value, target) чтобы не уйти дальше. Но мы храним только "не позже". Оставим безопасно:
-    u_wake = max(u_wake, hhmm_to_minutes(WAKE_END))
-    u_sleep = max(u["sleep_target"], hhmm_to_minutes(SLEEP_END))
+    u_sleep = max(u["sleep_target"], SLEEP_END_MIN)
     return u_read, u_focus, u_screen, u_tg, u_wake, u_sleep
 
-async def schedule_for_user(app, chat_id: int, tz: zoneinfo.ZoneInfo):
-    # ежедневные джобы
-    app.job_queue.run_daily(morning_job, time=time(MORNING_HH, MORNING_MM, tzinfo=tz), data={"chat_id": chat_id}, name=f"morning-{chat_id}")
-    app.job_queue.run_daily(evening_job, time=time(EVENING_HH, EVENING_MM, tzinfo=tz), data={"chat_id": chat_id}, name=f"evening-{chat_id}")
-
+def mark(phase: str, **extra):
+    STARTUP[phase] = round(perf_counter() - T0, 4)
+    STARTUP.update(extra)
+    metrics.STARTUP.set(STARTUP[phase], phase=phase)
+
+def goals_text(u) -> str:
+    key = ("goals", *(int(round(v)) for v in clamp_targets(u)))
+    msg = texts.get(key)
+    if msg is None:
+        r, f, s, tg, w, sl = key[1:]
+        msg = "\n".join([
+            "Доброе утро!!!",
+            f"Сегодняшние цели:",
+            f"• Чтение: ≥ {r} мин",
+            f"• Глубокий фокус: ≥ {f} мин",
+            f"• Экранное время: ≤ {s} мин",
+            f"• Telegram: ≤ {tg} мин (всегда ≤ экрана)",
+            f"• Подъём: не позже {minutes_to_hhmm(w)}",
+            f"• Сон: не позже {minutes_to_hhmm(sl)}",
+        ])
+        texts.put(key, msg)
+    return msg
+
+def targets_text(u) -> str:
+    # блок целей для /stats (без поджатия, tg <= экрана)
+    key = ("stats", *(int(round(u[c])) for c in ("reading_target", "focus_target", "screen_target",
+                                                "wake_target", "sleep_target")),
+           int(round(min(u["tg_target"], u["screen_target"]))))
+    msg = texts.get(key)
+    if msg is None:
+        r, f, s, w, sl, tg = key[1:]
+        msg = (
+            f"Текущие цели (с допусками по времени):\n"
+            f"Чтение ≥ {r} мин\n"
+            f"Фокус ≥ {f} мин\n"
+            f"Экран ≤ {s} мин\n"
+            f"Telegram ≤ {tg} мин\n"
+            f"Подъём не позже {minutes_to_hhmm(w)} (+{WAKE_TOL_MIN} мин)\n"
+            f"Сон не позже {minutes_to_hhmm(sl)} (+{SLEEP_TOL_MIN} мин)\n"
+        )
+        texts.put(key, msg)
+    return msg
+
+def outbox(context: ContextTypes.DEFAULT_TYPE) -> Broadcaster:
+    return context.application.bot_data["outbox"]
+
+async def fanout(items, send):
+    # рассылка пачками: не держим тысячи корутин разом, ошибки одного чата не валят остальных
+    for i in range(0, len(items), FANOUT_BATCH):
+        batch = items[i:i + FANOUT_BATCH]
+        res = await asyncio.gather(*(send(x) for x in batch), return_exceptions=True)
+        for x, r in zip(batch, res):
+            if isinstance(r, Exception):
+                log.warning("fanout failed for %s: %r", x, r)
+
+@timed(HANDLER_SECONDS)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    now = datetime.now(TZ).date().isoformat()
+    # повторный /start не сбрасывает выбранный пояс
+    u = await store.get_user(chat_id)
+    tz = u["tz"] if u else DEFAULT_TZ
+    now = local_today(tz).isoformat()
 
     t = initial_targets()
-    store.upsert_user(
-        chat_id, DEFAULT_TZ,
+    await store.upsert_user(
+        chat_id, tz,
         targets={"reading": t.reading, "focus": t.focus, "screen": t.screen, "tg": t.tg,
                  "wake": t.wake_min, "sleep": t.sleep_min},
         deltas={"reading": t.d_reading, "focus": t.d_focus, "screen": t.d_screen, "tg": t.d_tg,
                 "wake": t.d_wake, "sleep": t.d_sleep},
         start_date=now
     )
+    context.bot_data.setdefault("zones", set()).add(tz)
 
-    await schedule_for_user(context.application, chat_id, TZ)
     await update.message.reply_text(
         "Запущено! 60-дневная лестница активна.\n"
-        "Я буду писать каждое утро в 07:00 цели на день и в 22:50 — вечерний опрос.\n"
-        "Команды: /goals, /stats, /stop"
+        f"Я буду писать каждое утро в 07:00 цели на день и в 22:50 — вечерний опрос (пояс {tz}, сменить: /tz).\n"
+        "Команды: /goals, /stats, /top, /tz, /export, /stop"
     )
     # сразу показать сегодняшние цели если ещё не 07:00
     await send_goals(chat_id, context)
 
+@timed(HANDLER_SECONDS)
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    store.set_active(chat_id, 0)
+    await store.set_active(chat_id, 0)
     await update.message.reply_text("Остановил. Можешь снова /start когда будешь готов.")
 
+@timed(HANDLER_SECONDS)
+async def set_tz(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    u = await store.get_user(chat_id)
+    if not u:
+        await update.message.reply_text("Сначала /start.")
+        return
+    if not context.args:
+        await update.message.reply_text(f"Твой часовой пояс: {u['tz']}. Сменить: /tz Europe/Berlin")
+        return
+    name = context.args[0]
+    try:
+        zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        await update.message.reply_text("Не знаю такой пояс. Пример: /tz Europe/Moscow")
+        return
+    await store.set_tz(chat_id, name)
+    context.bot_data.setdefault("zones", set()).add(name)
+    await update.message.reply_text(f"Готово, пояс {name}. Цели в 07:00, опрос в 22:50 по местному времени.")
+
+@timed(HANDLER_SECONDS)
 async def goals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_goals(update.effective_chat.id, context)
 
-async def send_goals(chat_id: int, context: ContextTypes.DEFAULT_TYPE, with_week=False):
-    u = store.get_user(chat_id)
+@timed(HANDLER_SECONDS)
+async def send_goals(chat_id: int, context: ContextTypes.DEFAULT_TYPE, with_week=False, u=None, today=None):
+    if u is None:
+        u = await store.get_user(chat_id)
     if not u or not u["active"]:
         return
-    # поджать цели в разумные границы
-    r, f, s, tg, w, sl = clamp_targets(u)
-    # текст
-    msg = [
-        "Доброе утро!!!",
-        f"Сегодняшние цели:",
-        f"• Чтение: ≥ {int(round(r))} мин",
-        f"• Глубокий фокус: ≥ {int(round(f))} мин",
-        f"• Экранное время: ≤ {int(round(s))} мин",
-        f"• Telegram: ≤ {int(round(tg))} мин (всегда ≤ экрана)",
-        f"• Подъём: не позже {minutes_to_hhmm(int(round(w)))}",
-        f"• Сон: не позже {minutes_to_hhmm(int(round(sl)))}",
-    ]
+    msg = [goals_text(u)]
     # еженедельная сводка (каждые 7 дней после старта)
     if with_week:
         sd = date.fromisoformat(u["start_date"])
-        today = datetime.now(TZ).date()
+        today = today or local_today(u["tz"])
         days = (today - sd).days
         if days >= 7 and days % 7 == 0:
             d_from = (today - timedelta(days=7)).isoformat()
             d_to = (today - timedelta(days=1)).isoformat()
-            st = store.get_week_stats(chat_id, d_from, d_to)
+            st = await store.get_week_stats(chat_id, d_from, d_to)
             if st and st.get("days", 0) > 0:
-                avg_read = round((st["sum_reading"] or 0) / st["days"])
-                avg_focus = round((st["sum_focus"] or 0) / st["days"])
-                avg_screen = round((st["sum_screen"] or 0) / st["days"])
-                avg_tg = round((st["sum_tg"] or 0) / st["days"])
-                avg_wake = minutes_to_hhmm(int(round(st["avg_wake"] or 0)))
-                avg_sleep = minutes_to_hhmm(int(round(st["avg_sleep"] or 0)))
-                msg += [
-                    "",
-                    "Итоги за неделю:",
-                    f"• Чтение: сумм. {st['sum_reading'] or 0} мин (ср. {avg_read}/д)",
-                    f"• Глубокий фокус: сумм. {st['sum_focus'] or 0} мин (ср. {avg_focus}/д)",
-                    f"• Экран: сумм. {st['sum_screen'] or 0} мин (ср. {avg_screen}/д)",
-                    f"• Telegram: сумм. {st['sum_tg'] or 0} мин (ср. {avg_tg}/д)",
-                    f"• Подъём (ср.): {avg_wake}",
-                    f"• Сон (ср.): {avg_sleep}",
-                ]
-    await context.bot.send_message(chat_id=chat_id, text="\n".join(msg))
-
-async def morning_job(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.data["chat_id"]
-    await send_goals(chat_id, context, with_week=True)
-
-async def evening_job(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.data["chat_id"]
-    today = datetime.now(TZ).date().isoformat()
-    store.put_survey_state(chat_id, step=0, d=today)
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=(
-            "Вечерний опрос:\n"
-            "1) Сколько минут ты сегодня читал? (целое число)"
-        )
-    )
+                msg += ["", *period_lines("Итоги за неделю:", st)]
+    await outbox(context).send(chat_id, text="\n".join(msg))
+
+async def known_zones(context: ContextTypes.DEFAULT_TYPE):
+    # набор поясов активных юзеров держим в памяти, перечитываем раз в ZONES_TTL
+    bd = context.bot_data
+    now = datetime.now(timezone.utc)
+    if "zones_at" not in bd or now - bd["zones_at"] > ZONES_TTL:
+        bd["zones"] = set(await store.active_zones())
+        bd["zones_at"] = now
+    return bd["zones"]
+
+async def slot_tick(context: ContextTypes.DEFAULT_TYPE):
+    # одна джоба на всё: каждые TICK_SEC смотрим, в каких поясах наступил слот
+    now = datetime.now(timezone.utc)
+    prev = context.bot_data.get("tick_at", now)
+    context.bot_data["tick_at"] = now
+    if prev != now:
+        JOB_LAG.observe(max(0.0, (now - prev).total_seconds() - TICK_SEC), job="slot_tick")
+    # шарды, которые рассылает этот воркер: свой + осиротевшие, если он лидер
+    owned = shards.acquire()
+    if not owned:
+        return
+    try:
+        if shards.enabled and shards.lapsed and shards.index in owned and surveys_ready.is_set():
+            await reload_surveys()  # до warm() таблицу прочитает он сам
+        zones = await known_zones(context)
+        for hh, mm, fire in ((MORNING_HH, MORNING_MM, morning_job), (EVENING_HH, EVENING_MM, evening_job)):
+            for (d, offset), tzs in due_zones(zones, hh, mm, prev, now).items():
+                # воркер мог разослать слот и упасть, а лидер — подхватить его шард в том же окне
+                claimed = [i for i in owned
+                           if await store.claim_slot(fire.__name__, d.isoformat(), int(offset.total_seconds()) // 60, i)]
+                if not claimed:
+                    continue
+                JOB_LAG.observe((now - slot_instant(d, hh, mm, zone(tzs[0]))).total_seconds(), job=fire.__name__)
+                # рассылка может идти минутами — не держим тик
+                context.application.create_task(fire(context, tzs, d, (claimed, shards.count) if shards.enabled else None))
+    finally:
+        shards.release_adopted()
+
+async def reload_surveys():
+    # свой шард вернулся к нам: опросы, начатые за это время лидером, есть только в таблице
+    shards.lapsed = False
+    rows = await store.load_surveys()
+    n = len(surveys.load(r for r in rows if shards.mine(r["chat_id"])))
+    if n:
+        log.warning("picked up %s surveys started by the leader", n)
+
+async def cached_survey(chat_id: int):
+    if not surveys_ready.is_set():
+        await surveys_ready.wait()
+    s = surveys.get(chat_id)  # без похода в БД
+    if s is None and shards.enabled and shards.lapsed:
+        # свой шард сейчас у лидера -> опрос мог начать он; до перечитывания смотрим в таблицу
+        row = await store.get_survey_state(chat_id)
+        if row is not None and shards.mine(chat_id):
+            surveys.load([row])
+            s = surveys.get(chat_id)
+    return s
+
+def period_lines(title: str, st) -> list:
+    avg_read = round((st["sum_reading"] or 0) / st["days"])
+    avg_focus = round((st["sum_focus"] or 0) / st["days"])
+    avg_screen = round((st["sum_screen"] or 0) / st["days"])
+    avg_tg = round((st["sum_tg"] or 0) / st["days"])
+    avg_wake = minutes_to_hhmm(int(round(st["avg_wake"] or 0)))
+    avg_sleep = minutes_to_hhmm(int(round(st["avg_sleep"] or 0)))
+    return [
+        title,
+        f"• Чтение: сумм. {st['sum_reading'] or 0} мин (ср. {avg_read}/д)",
+        f"• Глубокий фокус: сумм. {st['sum_focus'] or 0} мин (ср. {avg_focus}/д)",
+        f"• Экран: сумм. {st['sum_screen'] or 0} мин (ср. {avg_screen}/д)",
+        f"• Telegram: сумм. {st['sum_tg'] or 0} мин (ср. {avg_tg}/д)",
+        f"• Подъём (ср.): {avg_wake}",
+        f"• Сон (ср.): {avg_sleep}",
+    ]
+
+async def morning_job(context: ContextTypes.DEFAULT_TYPE, tzs, d: date, shard=None):
+    async for page in store.iter_active_users(FANOUT_BATCH, MORNING_COLS, tzs, shard):
+        await fanout(page, lambda u: send_goals(u["chat_id"], context, with_week=True, u=u, today=d))
+    log.info("morning broadcast %s: %s, user cache %s", d, outbox(context).stats(), store.cache_stats())
+
+async def evening_job(context: ContextTypes.DEFAULT_TYPE, tzs, d: date, shard=None):
+    async for page in store.iter_active_users(FANOUT_BATCH, ("chat_id",), tzs, shard):
+        chat_ids = [u["chat_id"] for u in page]
+        await store.start_surveys(chat_ids, d.isoformat())
+        # ответы чужого шарда придут его воркеру, он поднимет опрос из таблицы survey
+        surveys.start([c for c in chat_ids if shards.mine(c)], d.isoformat())
+        if SURVEY_BUTTONS:
+            first = {"d": d.isoformat()}
+            await fanout(chat_ids, lambda chat_id: outbox(context).send(
+                chat_id, text=survey_text(first, 0), reply_markup=survey_markup(first, 0)))
+            continue
+        await fanout(chat_ids, lambda chat_id: outbox(context).send(
+            chat_id,
+            text=(
+                "Вечерний опрос:\n"
+                "1) Сколько минут ты сегодня читал? (целое число)"
+            )
+        ))
+    log.info("evening broadcast %s: %s", d, outbox(context).stats())
+
+def clock(start: int, end: int, step: int = 30):
+    return tuple(minutes_to_hhmm(m) for m in range(start, end + 1, step))
+
+# (поле, подпись, вопрос, пресеты); время — как ввёл бы текстом (HH:MM)
+SURVEY_STEPS = (
+    ("tmp_reading", "Чтение", "1) Сколько минут ты сегодня читал?", (0, 10, 20, 30, 45, 60, 90, 120)),
+    ("tmp_focus", "Фокус", "2) Сколько минут глубокого фокуса сегодня?", (0, 15, 30, 45, 60, 90, 120, 180)),
+    ("tmp_screen", "Экран", "3) Сколько минут всего экранного времени сегодня?",
+     (60, 90, 120, 150, 180, 240, 300, 360, 420, 480, 600, 720)),
+    ("tmp_tg", "Telegram", "4) Сколько минут в Telegram? (не больше экрана)",
+     (0, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300)),
+    ("tmp_wake", "Подъём", "5) Во сколько ты сегодня проснулся?", clock(5 * 60, 10 * 60 + 30)),
+    ("tmp_sleep", "Сон", "6) Во сколько ложишься спать?", clock(21 * 60, 24 * 60 + 60)),
+)
+
+def survey_markup(s, step: int) -> InlineKeyboardMarkup:
+    # callback_data "sv:<d>:<шаг>:<ответ>" — шаг и дата отсекают нажатия по устаревшим клавиатурам
+    presets = SURVEY_STEPS[step][3]
+    if SURVEY_STEPS[step][0] == "tmp_tg":
+        screen = s["tmp_screen"] or 0
+        presets = [v for v in presets if v < screen] + [screen]
+    buttons = [InlineKeyboardButton(str(v), callback_data=f"sv:{s['d']}:{step}:{v}") for v in presets]
+    return InlineKeyboardMarkup([buttons[i:i + 4] for i in range(0, len(buttons), 4)])
+
+def survey_text(s, step: int) -> str:
+    lines = ["Вечерний опрос (кнопкой или числом):"]
+    for field, label, _, _ in SURVEY_STEPS[:step]:
+        v = s[field]
+        lines.append(f"✓ {label}: {minutes_to_hhmm(v) if field in ('tmp_wake', 'tmp_sleep') else f'{v} мин'}")
+    lines.append(SURVEY_STEPS[step][2])
+    return "\n".join(lines)
 
 def success_flags(u, done) -> Dict[str, bool]:
     ok_reading = (done["reading_done"] >= int(round(u["reading_target"])))
@@ -144,9 +372,11 @@ def success_flags(u, done) -> Dict[str, bool]:
         "tg": ok_tg, "wake": ok_wake, "sleep": ok_sleep
     }
 
+@timed(HANDLER_SECONDS)
 async def finalize_day(chat_id: int, d: str, context: ContextTypes.DEFAULT_TYPE):
-    s = store.get_survey_state(chat_id)
-    u = store.get_user(chat_id)
+    # итог дня текстом (None — опроса или юзера уже нет); отправляет вызывающий
+    s = surveys.get(chat_id)
+    u = await store.get_user(chat_id)
     if not s or not u: 
         return
     # валидации: tg <= screen уже проверяли при вводе
@@ -165,15 +395,12 @@ async def finalize_day(chat_id: int, d: str, context: ContextTypes.DEFAULT_TYPE)
     delta = (sum(1 for v in inc.values() if v) * PTS_OK) + (PTS_ALL_OK_BONUS if all(inc.values()) else 0)
     delta += (sum(1 for v in inc.values() if not v) * PTS_FAIL)
 
-    pts, streak = store.add_points_and_streak(chat_id, delta, success_all=all(inc.values()), any_fail=any_fail)
-
-    # лог + обновление целей/дня
-    store.upsert_log(chat_id, d, **done,
-                     ok_reading=int(inc["reading"]), ok_focus=int(inc["focus"]),
-                     ok_screen=int(inc["screen"]), ok_tg=int(inc["tg"]),
-                     ok_wake=int(inc["wake"]), ok_sleep=int(inc["sleep"]))
-    store.update_targets_after_day(chat_id, inc)
-    store.clear_survey(chat_id)
+    # очки, лог, цели и чистка опроса — одной транзакцией
+    res = await store.finalize_day(chat_id, d, done, inc, delta)
+    surveys.drop(chat_id)
+    if not res:
+        return
+    pts, streak = res
 
     # ответ
     lines = ["Сохранено!"]
@@ -189,16 +416,20 @@ async def finalize_day(chat_id: int, d: str, context: ContextTypes.DEFAULT_TYPE)
         f"Очки за сегодня: {delta:+d}",
         f"Твои очки: {pts}, Стрик: {streak}"
     ]
+    rank = await store.user_rank(chat_id)  # из памяти, без запроса к users
+    if rank:
+        lines.append(f"Место: #{rank[0]} из {rank[1]}")
     # микро-поощрение/наказание (текстом, без насилия)
     if all(inc.values()):
         lines.append("Награда: +50 бонуса за идеальный день. Красавчик!")
     elif any_fail:
         lines.append("Штраф: цели не растут по пунктам с ❌. Завтра попробуем снова.")
-    await context.bot.send_message(chat_id=chat_id, text="\n".join(lines))
+    return "\n".join(lines)
 
+@timed(HANDLER_SECONDS)
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    s = store.get_survey_state(chat_id)
+    s = await cached_survey(chat_id)
     if not s:
         return  # игнорим обычные тексты вне опроса
 
@@ -220,7 +451,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if v is None:
             await update.message.reply_text("Введи целое число минут чтения.")
             return
-        store.set_survey_value(chat_id, "tmp_reading", v, 1)
+        surveys.answer(chat_id, "tmp_reading", v, 1)
         await update.message.reply_text("2) Сколько минут глубокого фокуса сегодня?")
         return
 
@@ -229,7 +460,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if v is None:
             await update.message.reply_text("Введи целое число минут фокуса.")
             return
-        store.set_survey_value(chat_id, "tmp_focus", v, 2)
+        surveys.answer(chat_id, "tmp_focus", v, 2)
         await update.message.reply_text("3) Сколько минут всего экранного времени сегодня?")
         return
 
@@ -238,7 +469,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if v is None:
             await update.message.reply_text("Введи минуты экрана (0–1440).")
             return
-        store.set_survey_value(chat_id, "tmp_screen", v, 3)
+        surveys.answer(chat_id, "tmp_screen", v, 3)
         await update.message.reply_text("4) Сколько минут в Telegram? (не больше экрана)")
         return
 
@@ -248,11 +479,11 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Введи минуты в Telegram (0–1440).")
             return
         # проверка tg <= screen
-        screen = store.get_survey_state(chat_id)["tmp_screen"] or 0
+        screen = s["tmp_screen"] or 0
         if v > screen:
             await update.message.reply_text(f"Telegram не может быть больше экрана. Введи число ≤ {screen}.")
             return
-        store.set_survey_value(chat_id, "tmp_tg", v, 4)
+        surveys.answer(chat_id, "tmp_tg", v, 4)
         await update.message.reply_text("5) Во сколько ты сегодня проснулся? (часы:минуты, 24ч, например 07:15)")
         return
 
@@ -262,7 +493,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             await update.message.reply_text("Формат времени HH:MM, например 07:15.")
             return
-        store.set_survey_value(chat_id, "tmp_wake", v, 5)
+        surveys.answer(chat_id, "tmp_wake", v, 5)
         await update.message.reply_text("6) Во сколько сегодня ложишься спать? (последний вопрос, введи прямо перед сном)")
         return
 
@@ -272,47 +503,286 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             await update.message.reply_text("Формат времени HH:MM, например 23:05.")
             return
-        store.set_survey_value(chat_id, "tmp_sleep", v, 6)
+        surveys.answer(chat_id, "tmp_sleep", v, 6)
         # финализация
-        await finalize_day(chat_id, today, context)
+        text = await finalize_day(chat_id, today, context)
+        if text:
+            await outbox(context).send(chat_id, text=text)
+        return
+
+@timed(HANDLER_SECONDS)
+async def survey_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    chat_id = update.effective_chat.id
+    try:
+        _, d, step, raw = q.data.split(":", 3)
+        step = int(step)
+        field = SURVEY_STEPS[step][0]
+        v = hhmm_to_minutes(raw) if ":" in raw else int(raw)
+    except (ValueError, IndexError):
+        await q.answer()
+        return
+    s = await cached_survey(chat_id)
+    if not s or s["d"] != d:
+        await q.answer("Этот опрос уже закрыт.")
+        await q.edit_message_reply_markup(None)
         return
+    if s["step"] != step:
+        # двойное нажатие, ответ текстом или рестарт (шаги кнопками не пишутся в БД) -> текущий шаг
+        await q.answer()
+        try:
+            await q.edit_message_text(survey_text(s, s["step"]), reply_markup=survey_markup(s, s["step"]))
+        except BadRequest:
+            pass  # "message is not modified"
+        return
+    if field == "tmp_tg" and v > (s["tmp_screen"] or 0):
+        await q.answer("Telegram не может быть больше экрана.")
+        return
+    surveys.answer(chat_id, field, v, step + 1, persist=False)
+    if step + 1 < len(SURVEY_STEPS):
+        # ack и правка сообщения — параллельно, это два независимых вызова API
+        await asyncio.gather(q.answer(), q.edit_message_text(survey_text(s, step + 1),
+                                                             reply_markup=survey_markup(s, step + 1)))
+        return
+    await q.answer()
+    text = await finalize_day(chat_id, d, context)
+    if text:
+        await q.edit_message_text(text)
 
+@timed(HANDLER_SECONDS)
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    u = store.get_user(chat_id)
+    u = await store.get_user(chat_id)
     if not u:
         await update.message.reply_text("Сначала /start.")
         return
+    period = context.args[0].lower() if context.args else ""
+    if period in STATS_PERIODS:
+        # /stats week|month|all — из log_rollup, без скана истории
+        today = local_today(u["tz"])
+        days, title = STATS_PERIODS[period]
+        d_from = (today - timedelta(days=days - 1)).isoformat() if days else u["start_date"]
+        st = await store.get_range_stats(chat_id, d_from, today.isoformat())
+        if not st["days"]:
+            await update.message.reply_text("За этот период ещё нет записей.")
+            return
+        await update.message.reply_text("\n".join(period_lines(f"{title} ({st['days']} дн.):", st)))
+        return
+    rank = await store.user_rank(chat_id)
     txt = (
         f"День лестницы: {u['day_index']}/{DURATION_DAYS}\n"
-        f"Очки: {u['points']} | Стрик: {u['streak']}\n\n"
-        f"Текущие цели (с допусками по времени):\n"
-        f"Чтение ≥ {int(round(u['reading_target']))} мин\n"
-        f"Фокус ≥ {int(round(u['focus_target']))} мин\n"
-        f"Экран ≤ {int(round(u['screen_target']))} мин\n"
-        f"Telegram ≤ {int(round(min(u['tg_target'], u['screen_target'])))} мин\n"
-        f"Подъём не позже {minutes_to_hhmm(int(round(u['wake_target'])))} (+{WAKE_TOL_MIN} мин)\n"
-        f"Сон не позже {minutes_to_hhmm(int(round(u['sleep_target'])))} (+{SLEEP_TOL_MIN} мин)\n"
+        f"Очки: {u['points']} | Стрик: {u['streak']}\n"
+        + (f"Место: #{rank[0]} из {rank[1]} (/top)\n" if rank else "")
+        + "\n" + targets_text(u)
     )
     await update.message.reply_text(txt)
 
-def main():
-    store.init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
+@timed(HANDLER_SECONDS)
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    rows = await store.top_users(TOP_N)
+    if not rows:
+        await update.message.reply_text("Таблица пока пуста.")
+        return
+    lines = [f"Топ-{len(rows)} по очкам:"]
+    place = 0
+    for i, r in enumerate(rows):
+        # равные очки — одно место
+        if i == 0 or r["points"] != rows[i - 1]["points"]:
+            place = i + 1
+        me = "  ← ты" if r["chat_id"] == chat_id else ""
+        lines.append(f"{place}. {r['points']} очк., стрик {r['streak']}{me}")
+    rank = await store.user_rank(chat_id)
+    if rank:
+        lines += ["", f"Ты на месте #{rank[0]} из {rank[1]}."]
+    await update.message.reply_text("\n".join(lines))
+
+@timed(HANDLER_SECONDS)
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /export [gz] — вся история логов юзера файлом; пишем пачками, крупное уходит на диск
+    chat_id = update.effective_chat.id
+    fmt = "csv.gz" if context.args and context.args[0].lower() == "gz" else "csv"
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as f:
+        n = await dump(store, "logs", f, fmt, chat_id=chat_id)
+        if not n:
+            await update.message.reply_text("Пока нечего выгружать: записей нет.")
+            return
+        f.seek(0)
+        # PTB всё равно читает файл целиком перед multipart-загрузкой
+        await update.message.reply_document(document=f.read(), filename=f"logs-{chat_id}.{fmt}",
+                                            caption=f"Твои записи: {n} дн.")
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    # онлайн-снимок bot.db в фоне; в шардированном режиме база одна -> снимает только лидер
+    if shards.enabled and not shards.leader:
+        return
+    from app.db import DB_PATH
+    st = await asyncio.get_running_loop().run_in_executor(None, backup.run, DB_PATH)
+    for k in ("bytes", "seconds", "mb_per_s", "max_step_ms"):
+        metrics.BACKUP.set(st[k], stat=k)
+    metrics.BACKUP.set(datetime.now(timezone.utc).timestamp(), stat="finished_at")
+    log.info("backup %s: %s MB in %ss (%s MB/s, longest step %s ms), rotated %s",
+             st["path"], round(st["bytes"] / 2**20, 1), st["seconds"], st["mb_per_s"], st["max_step_ms"], st["rotated"])
+
+async def flush_surveys(context: ContextTypes.DEFAULT_TYPE = None):
+    rows = surveys.take_dirty()
+    if not rows:
+        return
+    try:
+        await store.save_surveys(rows)
+    except Exception:
+        surveys.mark_dirty(rows)
+        raise
+
+async def on_error(update, context: ContextTypes.DEFAULT_TYPE):
+    # ошибки хендлеров и прямых ответов: в лог (как без обработчика) + счётчик по типу;
+    # пришедшие из outbox уже посчитаны там
+    if isinstance(context.error, TelegramError) and not broadcast.counted(context.error):
+        TG_ERRORS.inc(kind=type(context.error).__name__)
+        if isinstance(context.error, RetryAfter):
+            TG_RETRY_AFTER.inc()
+    log.error("update %s failed", getattr(update, "update_id", None), exc_info=context.error)
+
+def clean_mark() -> str:
+    return f"{CLEAN_MARK}.{shards.index}" if shards.enabled else CLEAN_MARK
+
+def take_clean_mark() -> bool:
+    # True -> прошлый процесс остановился штатно; маркер снимаем сразу, чтобы падение этого его не оставило
+    try:
+        os.remove(clean_mark())
+        return True
+    except FileNotFoundError:
+        return False
+
+def put_clean_mark():
+    os.makedirs(os.path.dirname(clean_mark()) or ".", exist_ok=True)
+    open(clean_mark(), "w").close()
+
+async def ask_again(ob: Broadcaster, restored):
+    # после падения в таблице шаг последнего flush (до SURVEY_FLUSH_SEC назад), а бот мог уже задать
+    # следующий вопрос -> следующий ответ лёг бы не в то поле. Повторяем вопрос текущего шага.
+    # Шаг 0 не трогаем: первый вопрос ушёл вечерней рассылкой, ответов по нему не было, терять нечего.
+    # Опросы старше вчерашнего (UTC) тоже: их не забыли из-за рестарта, их просто не прошли
+    recent = (datetime.now(timezone.utc).date() - timedelta(days=1)).isoformat()
+    again = [s for s in restored if s.d >= recent and 0 < s.step < len(SURVEY_STEPS)]
+
+    async def send(s):
+        if SURVEY_BUTTONS:
+            await ob.send(s.chat_id, text=survey_text(s, s.step), reply_markup=survey_markup(s, s.step))
+        else:
+            await ob.send(s.chat_id, text="Бот перезапускался, повтори ответ, пожалуйста:\n"
+                                          + SURVEY_STEPS[s.step][2])
+    await fanout(again, send)
+    return len(again)
+
+async def warm(app):
+    # всё, что растёт с числом юзеров, — после старта: апдейты уже принимаются
+    clean = take_clean_mark()
+    try:
+        rows = await store.load_surveys()
+        restored = surveys.load(r for r in rows if shards.mine(r["chat_id"]))
+        mark("surveys", surveys_loaded=len(rows))
+    finally:
+        surveys_ready.set()
+    STARTUP["surveys_asked_again"] = 0 if clean else await ask_again(app.bot_data["outbox"], restored)
+    bd = app.bot_data
+    bd["zones"] = set(await store.active_zones()) | bd.get("zones", set())
+    bd["zones_at"] = datetime.now(timezone.utc)
+    mark("zones")
+    await store.refresh_ranks()
+    mark("ranks")
+    for step in ladder():
+        goals_text(step)  # юзеры, идущие по лестнице без срывов, сразу попадают в кэш текстов
+        targets_text(step)
+    mark("warm")
+    log.info("startup: %s", STARTUP)
+    if bd.get("profile"):
+        print("startup " + json.dumps(STARTUP), file=sys.stderr, flush=True)
+
+async def first_update(update, context: ContextTypes.DEFAULT_TYPE):
+    # только с --profile-startup: момент первого апдейта; фазы в stderr JSON-строкой (и ещё раз после прогрева)
+    if "first_update" not in STARTUP:
+        mark("first_update")
+        print("startup " + json.dumps(STARTUP), file=sys.stderr, flush=True)
+
+async def on_startup(app):
+    mark("initialize")
+    await store.init_db()
+    mark("init_db")
+    ob = app.bot_data["outbox"] = Broadcaster(app.bot)
+    for k in ("sent", "failed", "throttled", "backlog", "rate"):
+        metrics.BROADCAST.set_function(lambda k=k: ob.stats()[k], stat=k)
+    for k in ("size", "hits", "misses", "hit_rate"):
+        metrics.USER_CACHE.set_function(lambda k=k: store.cache_stats()[k], stat=k)
+    if "metrics_server" in app.bot_data:
+        await app.bot_data["metrics_server"].start()
+    app.bot_data["warm"] = asyncio.create_task(warm(app))
+    mark("ready")
+
+async def on_shutdown(app):
+    if "warm" in app.bot_data:
+        app.bot_data["warm"].cancel()
+    await flush_surveys()
+    put_clean_mark()  # только если flush прошёл: иначе после рестарта переспросим
+    await app.bot_data["outbox"].close()
+    await store.close()
+    shards.close()
+    if "metrics_server" in app.bot_data:
+        await app.bot_data["metrics_server"].stop()
+
+def build_app(concurrency: int = None, profile: bool = False):
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    if BOT_API_URL:
+        # локальный Bot API / фейковый сервер для офлайн-проверок
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    if concurrency:
+        builder = builder.concurrent_updates(ChatOrderedProcessor(concurrency))
+    app = builder.build()
+
+    if profile:
+        app.bot_data["profile"] = True
+        app.add_handler(TypeHandler(Update, first_update), group=-1)
     # команды
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("stop", stop))
     app.add_handler(CommandHandler("goals", goals))
     app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("top", top))
+    app.add_handler(CommandHandler("export", export))
+    app.add_handler(CommandHandler("tz", set_tz))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), text_handler))
-
-    # рескейджул джобы для активных юзеров после рестарта
-    for u in store.all_active_users():
-        app.job_queue.run_daily(morning_job, time=time(MORNING_HH, MORNING_MM, tzinfo=TZ), data={"chat_id": u["chat_id"]}, name=f"morning-{u['chat_id']}")
-        app.job_queue.run_daily(evening_job, time=time(EVENING_HH, EVENING_MM, tzinfo=TZ), data={"chat_id": u["chat_id"]}, name=f"evening-{u['chat_id']}")
-
-    app.run_polling(close_loop=False)
+    app.add_handler(CallbackQueryHandler(survey_button, pattern=r"^sv:"))
+    app.add_error_handler(on_error)
+
+    # одна джоба-тик на все пояса, юзеры выбираются в момент слота
+    app.job_queue.run_repeating(slot_tick, interval=TICK_SEC, first=0, name="slots")
+    app.job_queue.run_repeating(flush_surveys, interval=SURVEY_FLUSH_SEC, name="survey-flush")
+    if backup.BACKUP_EVERY_MIN and isinstance(store, AsyncStore):
+        # Postgres бэкапится своими средствами (pg_dump / PITR)
+        app.job_queue.run_repeating(backup_job, interval=backup.BACKUP_EVERY_MIN * 60,
+                                    first=backup.BACKUP_EVERY_MIN * 60, name="backup")
+    return app
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="app.bot")
+    p.add_argument("--webhook", action="store_true", help="принимать апдейты вебхуком вместо long polling")
+    p.add_argument("--shard", help="i/N: воркер шарда i из N (запускает python -m app.shard)")
+    p.add_argument("--profile-startup", action="store_true",
+                   help="фазы старта (import, init_db, ready, прогрев, первый апдейт) в stderr")
+    args = p.parse_args(argv)
+    if args.shard:
+        if not args.webhook:
+            p.error("--shard работает только с --webhook: апдейты раздаёт фронт app.shard")
+        shards.index, shards.count = parse_shard(args.shard)
+
+    app = build_app(WEBHOOK_CONCURRENCY if args.webhook else None, args.profile_startup)
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = server = HttpServer(METRICS_HOST, int(METRICS_PORT))
+        server.route("GET", "/metrics", metrics.handle)
+    if args.webhook:
+        asyncio.run(webhook.serve(app, webhook.webhook_server(app)))
+    else:
+        app.run_polling(close_loop=False)
 
 if __name__ == "__main__":
     main()
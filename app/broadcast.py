@@ -0,0 +1,150 @@
+import asyncio, logging, os, time
+from collections import deque
+from datetime import timedelta
+from typing import Deque, Dict, Tuple
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from app.metrics import TG_ERRORS, TG_RETRY_AFTER
+
+log = logging.getLogger(__name__)
+
+# глобальный лимит Telegram ~30 сообщений/с, берём с запасом
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "3"))
+
+
+def counted(e: BaseException) -> bool:
+    # ошибку уже посчитал Broadcaster (отправка через outbox сдалась) -> on_error не считает второй раз
+    return getattr(e, "_outbox_counted", False)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.t = time.monotonic()
+        self.resume_at = 0.0
+
+    def pause(self, seconds: float):
+        # 429 от Telegram действует на всего бота -> стопорим всех
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.resume_at:
+                await asyncio.sleep(self.resume_at - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    # очередь между джобами и Bot API: лимит скорости, порядок внутри чата,
+    # повтор после RetryAfter, ограниченное число одновременных запросов
+    def __init__(self, bot, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 retries: int = BROADCAST_RETRIES):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.retries = retries
+        self._chats: Dict[int, Deque[Tuple[dict, asyncio.Future]]] = {}
+        self._ready: asyncio.Queue = None
+        self._workers = []
+        self._recent: Deque[float] = deque(maxlen=1024)
+        self.backlog = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+
+    def send(self, chat_id: int, **kwargs) -> asyncio.Future:
+        if not self._workers:
+            self._start()
+        fut = asyncio.get_running_loop().create_future()
+        q = self._chats.get(chat_id)
+        if q is None:
+            # чат попадает в ready максимум один раз -> сообщения одного чата идут по порядку
+            q = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        q.append((kwargs, fut))
+        self.backlog += 1
+        return fut
+
+    def _start(self):
+        self._ready = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            q = self._chats[chat_id]
+            kwargs, fut = q[0]
+            try:
+                res = await self._send(chat_id, kwargs)
+            except Exception as e:
+                # один раз на сообщение, когда повторы кончились, — не на каждую попытку
+                self.failed += 1
+                TG_ERRORS.inc(kind=type(e).__name__)
+                e._outbox_counted = True
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(res)
+            q.popleft()
+            self.backlog -= 1
+            if q:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    async def _send(self, chat_id: int, kwargs: dict):
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                res = await self.bot.send_message(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                ra = e.retry_after
+                if isinstance(ra, timedelta):
+                    ra = ra.total_seconds()
+                self.throttled += 1
+                TG_RETRY_AFTER.inc()
+                log.warning("429 from Telegram, pausing broadcast for %ss", ra)
+                self.bucket.pause(float(ra))
+                continue
+            except BadRequest:
+                raise  # NetworkError-наследник, но повтор не поможет
+            except NetworkError:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+                continue
+            self.sent += 1
+            self._recent.append(time.monotonic())
+            return res
+
+    def rate(self) -> float:
+        if len(self._recent) < 2:
+            return 0.0
+        span = time.monotonic() - self._recent[0]
+        return len(self._recent) / span if span > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "failed": self.failed, "throttled": self.throttled,
+                "backlog": self.backlog, "rate": round(self.rate(), 1)}
+
+    async def close(self):
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
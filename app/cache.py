@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+_MISSING = object()
+
+
+class LRU:
+    # потокобезопасный LRU для read-through кешей app.db (читают потоки AsyncStore)
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            v = self._data.get(key, _MISSING)
+            if v is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return v
+
+    def token(self) -> int:
+        # взять ДО чтения из БД и отдать в put: если между ними была инвалидация, значение не кладём
+        return self._epoch
+
+    def put(self, key: Hashable, value: Any, token: Optional[int] = None):
+        with self._lock:
+            if token is not None and token != self._epoch:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -94,3 +94,19 @@ def initial_targets():
         d_wake=d_wake,
         d_sleep=d_sleep,
     )
+
+def ladder():
+    # цели после i дней, выполненных по всем пунктам (i = 0..DURATION_DAYS) — как их двигает rules.next_targets
+    t = initial_targets()
+    steps = []
+    for i in range(DURATION_DAYS + 1):
+        screen = t.screen + i * t.d_screen
+        steps.append({
+            "reading_target": t.reading + i * t.d_reading,
+            "focus_target": t.focus + i * t.d_focus,
+            "screen_target": screen,
+            "tg_target": min(t.tg + i * t.d_tg, screen),
+            "wake_target": t.wake_min + i * t.d_wake,
+            "sleep_target": t.sleep_min + i * t.d_sleep,
+        })
+    return steps
@@ -0,0 +1,331 @@
+import argparse, asyncio, os, sys, tempfile, traceback, uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+# общий набор проверок контракта app.storage.Store для всех бэкендов.
+#   python -m app.conformance                          # только SQLite (временная база)
+#   python -m app.conformance --pg postgresql://...    # плюс PostgreSQL (в отдельной схеме)
+# Локальный Postgres: docker compose --profile pg up -d postgres
+# Плюс проверки без хранилища (расписание слотов), один раз на прогон.
+
+T = {"reading": 20.0, "focus": 30.0, "screen": 180.0, "tg": 90.0, "wake": 510.0, "sleep": 30.0}
+DL = {"reading": 1.5, "focus": 2.5, "screen": -2.0, "tg": -1.0, "wake": -1.5, "sleep": -1.5}
+ALL_OK = {k: True for k in T}
+DONE = {"reading_done": 30, "focus_done": 40, "screen_done": 100, "tg_done": 20,
+        "wake_actual": 420, "sleep_actual": 1400}
+
+
+async def check_users(store):
+    await store.upsert_user(101, "Europe/Amsterdam", T, DL, "2024-01-01")
+    u = await store.get_user(101)
+    assert u["active"] == 1 and u["tz"] == "Europe/Amsterdam" and u["points"] == 0
+    assert u["reading_target"] == 20.0 and u["d_focus"] == 2.5
+    assert await store.get_user(999999) is None
+
+    await store.add_points_and_streak(101, 40, False, False)
+    await store.set_active(101, 0)
+    await store.upsert_user(101, "Asia/Tokyo", T, DL, "2024-02-01")
+    u = await store.get_user(101)
+    # повторный /start: активен, новый пояс и старт, очки сохраняются
+    assert u["active"] == 1 and u["tz"] == "Asia/Tokyo" and u["start_date"] == "2024-02-01"
+    assert u["points"] == 40 and u["streak"] == 1
+
+    await store.set_tz(101, "Europe/Berlin")
+    assert (await store.get_user(101))["tz"] == "Europe/Berlin"
+    assert "Europe/Berlin" in await store.active_zones()
+    await store.set_active(101, 0)
+    assert not (await store.get_user(101))["active"]
+
+
+async def check_iter_active_users(store):
+    za, zb = "Conformance/A", "Conformance/B"
+    for c in range(200, 260):
+        await store.upsert_user(c, za if c % 2 else zb, T, DL, "2024-01-01")
+    await store.set_active(203, 0)
+    pages = [p async for p in store.iter_active_users(7, ("tz",), [za, zb])]
+    ids = [r["chat_id"] for p in pages for r in p]
+    assert all(len(p) <= 7 for p in pages)
+    assert sorted(ids) == [c for c in range(200, 260) if c != 203]
+    assert [r["tz"] for r in pages[0]] == [za] * len(pages[0])
+    assert set(await store.active_zones()) >= {za, zb}
+    # шардинг: 3 шарда, берём 0 и 2; отрицательные id (группы) тоже попадают в [0, n)
+    await store.upsert_user(-250, za, T, DL, "2024-01-01")
+    ids = [r["chat_id"] for p in [p async for p in store.iter_active_users(4, (), [za, zb], ([0, 2], 3))] for r in p]
+    assert sorted(ids) == sorted(c for c in [*range(200, 260), -250] if c != 203 and c % 3 in (0, 2))
+    assert [p async for p in store.iter_active_users(4, (), [za], ([], 3))] == []
+    try:
+        [p async for p in store.iter_active_users(5, ("chat_id; DROP TABLE users",))]
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown column accepted")
+
+
+async def check_points(store):
+    await store.upsert_user(301, "UTC", T, DL, "2024-01-01")
+    assert await store.add_points_and_streak(301, -30, False, True) == (0, 0)
+    assert await store.add_points_and_streak(301, 10, True, False) == (60, 1)
+    assert await store.add_points_and_streak(999998, 10, True, False) is None
+
+
+async def check_finalize_day(store):
+    await store.upsert_user(401, "UTC", T, DL, "2024-01-01")
+    await store.put_survey_state(401, 5, "2024-01-02")
+    flags = dict(ALL_OK, tg=False)
+    assert await store.finalize_day(401, "2024-01-02", DONE, flags, 30) == (30, 0)
+    u = await store.get_user(401)
+    assert u["day_index"] == 1 and u["reading_target"] == 21.5 and u["screen_target"] == 178.0
+    assert u["tg_target"] == 90.0
+    assert await store.get_survey_state(401) is None
+    st = await store.get_range_stats(401, "2024-01-02", "2024-01-02")
+    assert st["days"] == 1 and st["sum_reading"] == 30 and st["avg_wake"] == 420
+    assert await store.finalize_day(999997, "2024-01-02", DONE, flags, 30) is None
+
+    # tg <= screen после сдвига
+    await store.upsert_user(402, "UTC", dict(T, tg=180.0), dict(DL, tg=0.0), "2024-01-01")
+    await store.update_targets_after_day(402, ALL_OK, "2024-01-02")
+    u = await store.get_user(402)
+    assert u["tg_target"] == u["screen_target"] == 178.0 and u["day_index"] == 1
+    await store.update_targets_after_day(402, ALL_OK, "2024-01-02")  # тот же день — второй раз не двигает
+    assert (await store.get_user(402))["day_index"] == 1
+
+
+async def check_advance_targets(store):
+    d = "2031-05-05"  # свой день, чтобы не задеть логи других проверок
+    await store.upsert_user(501, "UTC", T, DL, "2024-01-01")
+    await store.upsert_user(502, "UTC", dict(T, tg=180.0), dict(DL, tg=0.0), "2024-01-01")
+    await store.upsert_user(503, "UTC", T, DL, "2024-01-01")
+    await store.upsert_log(501, d, ok_reading=1, ok_focus=0, ok_screen=1, ok_tg=1, ok_wake=0, ok_sleep=1)
+    await store.upsert_log(502, d, **{f"ok_{k}": 1 for k in T})
+    assert await store.advance_targets(d) == 2
+    assert await store.advance_targets(d) == 0  # повторно не двигает
+    u = await store.get_user(501)
+    assert (u["reading_target"], u["focus_target"], u["screen_target"], u["tg_target"],
+            u["wake_target"], u["sleep_target"], u["day_index"]) == (21.5, 30.0, 178.0, 89.0, 510.0, 28.5, 1)
+    assert (await store.get_user(502))["tg_target"] == 178.0
+    # сдвинутому за день по одному юзеру пакетный advance_targets цели не двигает
+    await store.upsert_user(504, "UTC", T, DL, "2024-01-01")
+    d2 = "2031-05-06"
+    await store.upsert_log(504, d2, **{f"ok_{k}": 1 for k in T})
+    await store.update_targets_after_day(504, ALL_OK, d2)
+    assert await store.advance_targets(d2) == 0 and (await store.get_user(504))["day_index"] == 1
+    assert (await store.get_user(503))["day_index"] == 0
+
+
+async def check_logs(store):
+    await store.upsert_log(601, "2024-03-01", reading_done=10, wake_actual=400)
+    await store.upsert_log(601, "2024-03-03", reading_done=30, focus_done=5, wake_actual=500)
+    await store.upsert_log(601, "2024-03-02", reading_done=20)
+    await store.upsert_log(601, "2024-03-01", focus_done=7)  # частичное обновление не трогает остальное
+    st = await store.get_range_stats(601, "2024-03-01", "2024-03-03")
+    assert st["days"] == 3 and st["sum_reading"] == 60 and st["sum_focus"] == 12
+    assert st["sum_screen"] == 0 and abs(st["avg_wake"] - 300) < 1e-9
+    st = await store.get_week_stats(601, "2024-03-02", "2024-03-09")
+    assert st["days"] == 2 and st["sum_reading"] == 50
+    assert (await store.get_range_stats(601, "2025-01-01", "2025-01-07"))["days"] == 0
+    try:
+        await store.upsert_log(601, "2024-03-01", **{"reading_done=0, points": 1})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown column accepted")
+
+
+async def check_survey(store):
+    await store.put_survey_state(701, 0, "2024-04-01")
+    await store.set_survey_value(701, "tmp_reading", 25, 1)
+    s = await store.get_survey_state(701)
+    assert s["step"] == 1 and s["tmp_reading"] == 25 and s["d"] == "2024-04-01"
+    await store.save_surveys([(3, 25, 40, 120, None, None, None, 701, "2024-04-01"),
+                              (1, 1, None, None, None, None, None, 799, "2024-04-01")])
+    s = await store.get_survey_state(701)
+    assert s["step"] == 3 and s["tmp_screen"] == 120
+    assert await store.get_survey_state(799) is None  # save_surveys не создаёт строк
+    await store.start_surveys([701, 702], "2024-04-02")
+    # запоздавший flush вчерашнего опроса не трогает новый
+    await store.save_surveys([(4, 25, 40, 120, 30, None, None, 701, "2024-04-01")])
+    s = await store.get_survey_state(701)
+    assert s["step"] == 0 and s["tmp_reading"] is None and s["d"] == "2024-04-02"
+    ids = {r["chat_id"] for r in await store.load_surveys()}
+    assert {701, 702} <= ids
+    await store.clear_survey(701)
+    assert await store.get_survey_state(701) is None
+    try:
+        await store.set_survey_value(702, "step", 5, 5)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown survey field accepted")
+
+
+async def check_export_import(store):
+    for i in range(1, 6):
+        await store.upsert_log(801, f"2024-05-0{i}", reading_done=i * 10, ok_reading=1)
+    pages = [p async for p in store.iter_rows("logs", 2, 801)]
+    rows = [tuple(r) for p in pages for r in p]
+    assert [len(p) for p in pages] == [2, 2, 1]
+    assert [r[1] for r in rows] == [f"2024-05-0{i}" for i in range(1, 6)] and rows[0][2] == 10
+    # те же строки под другим chat_id + перезапись одного дня
+    await store.import_rows("logs", ("chat_id", "d", "reading_done"), [(802, r[1], r[2]) for r in rows])
+    await store.import_rows("logs", ("chat_id", "d", "reading_done"), [(802, "2024-05-03", 100)])
+    st = await store.get_range_stats(802, "2024-05-02", "2024-05-04")
+    assert st["days"] == 3 and st["sum_reading"] == 20 + 100 + 40
+    await store.import_rows("users", ("chat_id", "tz", "active", "points"), [(803, "UTC", 0, 7)])
+    assert (await store.get_user(803))["points"] == 7
+    try:
+        await store.import_rows("logs", ("chat_id", "d", "points"), [(802, "2024-05-01", 1)])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown column accepted")
+
+
+async def check_claim_slot(store):
+    assert await store.claim_slot("evening_job", "2024-04-02", 180, 1)
+    assert not await store.claim_slot("evening_job", "2024-04-02", 180, 1)  # второй раз слот не наш
+    assert await store.claim_slot("evening_job", "2024-04-02", 180, 2)
+    assert await store.claim_slot("morning_job", "2024-04-02", 180, 1)
+    # неделей позже старые отметки вычищаются, новые не мешают друг другу
+    assert await store.claim_slot("evening_job", "2024-04-10", 180, 1)
+    assert await store.claim_slot("evening_job", "2024-04-02", 180, 1)
+
+
+async def check_group_commit(store):
+    # SQLite: записи параллельных хендлеров уходят одной транзакцией (app.batcher); падение одной
+    # операции откатывает только её SAVEPOINT, соседи по пачке коммитятся и получают результат
+    batcher = getattr(store, "_batcher", None)
+    if batcher is None:
+        return  # PostgreSQL и WRITE_DELAY_MS=0: группового коммита нет
+    pool = batcher.pool
+    for c in (1001, 1002):
+        await store.upsert_user(c, "UTC", T, DL, "2024-01-01")
+
+    def write_then_fail():
+        with pool.write() as con:
+            con.execute("UPDATE users SET points=777 WHERE chat_id IN (1001, 1002)")
+        raise RuntimeError("boom")
+
+    c0 = pool.commits
+    res = await asyncio.gather(store.set_tz(1001, "Asia/Tokyo"), batcher.submit(write_then_fail),
+                               store.set_tz(1002, "Asia/Tokyo"), return_exceptions=True)
+    assert res[0] is None and res[2] is None and isinstance(res[1], RuntimeError), res
+    assert pool.commits == c0 + 1  # одна пачка — один COMMIT
+    with pool.read() as con:
+        rows = con.execute("SELECT tz, points FROM users WHERE chat_id IN (1001, 1002)").fetchall()
+    assert [tuple(r) for r in rows] == [("Asia/Tokyo", 0)] * 2, [tuple(r) for r in rows]
+
+
+async def check_leaderboard(store):
+    # очки заведомо выше, чем у юзеров других проверок
+    for c, p in ((901, 100300), (902, 100100), (903, 100300), (904, 100200)):
+        await store.upsert_user(c, "UTC", T, DL, "2024-01-01")
+        await store.add_points_and_streak(c, p, False, True)
+    top = [(r["chat_id"], r["points"]) for r in await store.top_users(4)]
+    assert top == [(901, 100300), (903, 100300), (904, 100200), (902, 100100)], top
+    n = await store.refresh_ranks()
+    assert await store.user_rank(901) == await store.user_rank(903) == (1, n)
+    assert await store.user_rank(902) == (4, n)
+    # место меняется сразу после записи очков, без перечитывания
+    await store.add_points_and_streak(902, 500, False, True)
+    assert await store.user_rank(902) == (1, n) and await store.user_rank(901) == (2, n)
+    await store.upsert_user(905, "UTC", T, DL, "2024-01-01")
+    assert await store.finalize_day(905, "2024-01-02", DONE, ALL_OK, 200000) == (200050, 1)
+    assert await store.user_rank(905) == (1, n + 1) and await store.user_rank(902) == (2, n + 1)
+    await store.set_active(905, 0)
+    assert await store.user_rank(905) is None and await store.user_rank(902) == (1, n)
+    await store.upsert_user(905, "UTC", T, DL, "2024-01-01")
+    assert await store.user_rank(905) == (1, n + 1)
+    assert await store.user_rank(999996) is None
+
+
+CHECKS = [check_users, check_iter_active_users, check_points, check_finalize_day,
+          check_advance_targets, check_logs, check_survey, check_export_import, check_claim_slot,
+          check_group_commit, check_leaderboard]
+
+
+def check_slots_dst():
+    # тик раз в минуту через переходы на летнее/зимнее время: каждая зона получает слот ровно
+    # один раз за локальный день, включая несуществующее (02:30 весной) и двойное (02:30 осенью) время
+    from app.slots import due_zones
+    zones = ["Europe/Berlin", "Asia/Kathmandu"]  # Kathmandu: +05:45, без перевода часов
+    for start in (datetime(2024, 3, 29, tzinfo=timezone.utc), datetime(2024, 10, 25, tzinfo=timezone.utc)):
+        for hh, mm in ((2, 30), (21, 0)):
+            fired = Counter()
+            prev = start
+            for i in range(1, 4 * 24 * 60 + 1):
+                now = start + timedelta(minutes=i)
+                for (d, offset), tzs in due_zones(zones, hh, mm, prev, now).items():
+                    if "Asia/Kathmandu" in tzs:
+                        assert offset == timedelta(hours=5, minutes=45), offset
+                    fired.update((z, d) for z in tzs)
+                prev = now
+            # локальные дни целиком внутри окна, среди них — день перевода (31.03 / 27.10)
+            days = {(z, (start + timedelta(days=k)).date()) for z in zones for k in (1, 2, 3)}
+            assert all(fired[x] == 1 for x in days), (start, hh, mm, fired)
+            assert set(fired.values()) == {1}, (start, hh, mm, fired)
+
+
+PURE_CHECKS = [check_slots_dst]
+
+
+def run_pure() -> int:
+    failed = 0
+    for check in PURE_CHECKS:
+        try:
+            check()
+            print(f"[ok]   slots: {check.__name__}")
+        except Exception:
+            failed += 1
+            print(f"[FAIL] slots: {check.__name__}")
+            traceback.print_exc()
+    return failed
+
+
+async def run(name: str, store) -> int:
+    failed = 0
+    await store.init_db()
+    try:
+        for check in CHECKS:
+            try:
+                await check(store)
+                print(f"[ok]   {name}: {check.__name__}")
+            except Exception:
+                failed += 1
+                print(f"[FAIL] {name}: {check.__name__}")
+                traceback.print_exc()
+    finally:
+        await store.close()
+    return failed
+
+
+async def _pg(dsn: str) -> int:
+    import asyncpg
+    from app.pg import PgStore
+    schema = f"conformance_{uuid.uuid4().hex[:8]}"
+    con = await asyncpg.connect(dsn)
+    await con.execute(f"CREATE SCHEMA {schema}")
+    try:
+        return await run("postgres", PgStore(dsn, schema=schema))
+    finally:
+        await con.execute(f"DROP SCHEMA {schema} CASCADE")
+        await con.close()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="app.conformance")
+    p.add_argument("--pg", default=os.getenv("CONFORMANCE_PG", ""), help="DSN PostgreSQL")
+    args = p.parse_args(argv)
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="conformance-"), "bot.db")
+    from app.storage import open_store  # DB_PATH читается при импорте app.db
+
+    failed = run_pure()
+    failed += asyncio.run(run("sqlite", open_store("")))
+    if args.pg:
+        failed += asyncio.run(_pg(args.pg))
+    print(f"{failed} failed" if failed else "all backends conform")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,75 +1,177 @@
 import os, sqlite3
-from contextlib import contextmanager
-from datetime import date
-from typing import Optional, Dict, Any, Tuple, List
+from datetime import date, timedelta
+from typing import Optional, Dict, Any, Tuple, List, Iterator, Sequence
+
+from app import metrics
+from app.cache import LRU
+from app.pool import from_env
+from app.ranks import Leaderboard
+from app.rules import next_targets, next_points
+from app.storage import EXPORT_COLS, LOG_COLS, USER_COLS
+from app.survey import FIELDS as SURVEY_FIELDS
 
 DB_PATH = os.getenv("DB_PATH", "data/bot.db")
 
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-@contextmanager
+# один писатель + пул читателей на весь процесс (см. app/pool.py)
+pool = from_env(DB_PATH)
+
 def db():
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    try:
-        yield con
-        con.commit()
-    finally:
-        con.close()
+    # транзакция писателя; вложенные вызовы становятся SAVEPOINT
+    return pool.write()
 
-def init_db():
-    with db() as con:
-        cur = con.cursor()
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-          chat_id INTEGER PRIMARY KEY,
-          tz TEXT NOT NULL,
-          active INTEGER NOT NULL DEFAULT 0,
-          start_date TEXT,
-          day_index INTEGER NOT NULL DEFAULT 0,
-          reading_target REAL,
-          focus_target REAL,
-          screen_target REAL,
-          tg_target REAL,
-          wake_target REAL,
-          sleep_target REAL,
-          d_reading REAL, d_focus REAL, d_screen REAL, d_tg REAL, d_wake REAL, d_sleep REAL,
-          points INTEGER NOT NULL DEFAULT 0,
-          streak  INTEGER NOT NULL DEFAULT 0
-        );
-        """)
+def _read():
+    return pool.read()
+
+def close():
+    pool.close()
+
+class UserRow:
+    # компактная неизменяемая копия строки users для кеша (вместо sqlite3.Row)
+    __slots__ = USER_COLS
+
+    def __init__(self, row):
+        for k in USER_COLS:
+            setattr(self, k, row[k])
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return USER_COLS
+
+# read-through кеш get_user; сбрасывается после коммита любой записи в users
+user_cache = LRU(int(os.getenv("USER_CACHE_SIZE", "10000")))
+
+def _user_changed(chat_id: int):
+    pool.after_commit(lambda: user_cache.pop(chat_id))
+
+# таблица лидеров (/top, место юзера): в памяти, правится после коммита каждой записи очков
+leaderboard = Leaderboard()
+
+def _rank_set(con, chat_id: int):
+    # юзер стал активным: в таблицу с текущими очками
+    pts = con.execute("SELECT points FROM users WHERE chat_id=?", (chat_id,)).fetchone()
+    if pts is not None:
+        pool.after_commit(lambda: leaderboard.set(chat_id, pts[0]))
+
+# миграции схемы: PRAGMA user_version = число применённых. Только дописывать в конец,
+# каждая идемпотентна (старые базы могли получить часть изменений до появления версий)
+def _m_base(con):
+    cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+      chat_id INTEGER PRIMARY KEY,
+      tz TEXT NOT NULL,
+      active INTEGER NOT NULL DEFAULT 0,
+      start_date TEXT,
+      day_index INTEGER NOT NULL DEFAULT 0,
+      reading_target REAL,
+      focus_target REAL,
+      screen_target REAL,
+      tg_target REAL,
+      wake_target REAL,
+      sleep_target REAL,
+      d_reading REAL, d_focus REAL, d_screen REAL, d_tg REAL, d_wake REAL, d_sleep REAL,
+      points INTEGER NOT NULL DEFAULT 0,
+      streak  INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS logs (
+      chat_id INTEGER NOT NULL,
+      d TEXT NOT NULL,  -- YYYY-MM-DD
+      reading_done INTEGER,
+      focus_done INTEGER,
+      screen_done INTEGER,
+      tg_done INTEGER,
+      wake_actual INTEGER,
+      sleep_actual INTEGER,
+      ok_reading INTEGER,
+      ok_focus INTEGER,
+      ok_screen INTEGER,
+      ok_tg INTEGER,
+      ok_wake INTEGER,
+      ok_sleep INTEGER,
+      PRIMARY KEY (chat_id, d)
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS survey (
+      chat_id INTEGER PRIMARY KEY,
+      step INTEGER NOT NULL,
+      d TEXT NOT NULL,
+      tmp_reading INTEGER,
+      tmp_focus INTEGER,
+      tmp_screen INTEGER,
+      tmp_tg INTEGER,
+      tmp_wake INTEGER,
+      tmp_sleep INTEGER
+    );
+    """)
+
+def _m_targets_d(con):
+    # targets_d: день, по логу которого цели уже сдвинуты (защита от двойного advance_targets)
+    cols = {r["name"] for r in con.execute("PRAGMA table_info(users)")}
+    if "targets_d" not in cols:
+        con.execute("ALTER TABLE users ADD COLUMN targets_d TEXT")
+        con.execute("UPDATE users SET targets_d=(SELECT MAX(d) FROM logs WHERE logs.chat_id=users.chat_id)")
+
+def _m_log_rollup(con):
+    cur = con.cursor()
+    if not con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='log_rollup'").fetchone():
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS logs (
+        CREATE TABLE log_rollup (
           chat_id INTEGER NOT NULL,
-          d TEXT NOT NULL,  -- YYYY-MM-DD
-          reading_done INTEGER,
-          focus_done INTEGER,
-          screen_done INTEGER,
-          tg_done INTEGER,
-          wake_actual INTEGER,
-          sleep_actual INTEGER,
-          ok_reading INTEGER,
-          ok_focus INTEGER,
-          ok_screen INTEGER,
-          ok_tg INTEGER,
-          ok_wake INTEGER,
-          ok_sleep INTEGER,
-          PRIMARY KEY (chat_id, d)
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS survey (
-          chat_id INTEGER PRIMARY KEY,
-          step INTEGER NOT NULL,
           d TEXT NOT NULL,
-          tmp_reading INTEGER,
-          tmp_focus INTEGER,
-          tmp_screen INTEGER,
-          tmp_tg INTEGER,
-          tmp_wake INTEGER,
-          tmp_sleep INTEGER
-        );
+          n INTEGER NOT NULL,
+          c_reading INTEGER NOT NULL, c_focus INTEGER NOT NULL,
+          c_screen INTEGER NOT NULL, c_tg INTEGER NOT NULL,
+          c_wake INTEGER NOT NULL, c_sleep INTEGER NOT NULL,
+          PRIMARY KEY (chat_id, d)
+        ) WITHOUT ROWID;
         """)
+        cur.execute(_ROLLUP_BACKFILL.format(where=""))
+
+def _m_indexes(con):
+    # iter_active_users (по поясам) / active_zones / all_active_users: поиск по active без скана users
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_active_tz ON users(active, tz)")
+    # доступ к logs по дате (advance_targets, выгрузки за период); покрывает ok_*
+    con.execute("""
+    CREATE INDEX IF NOT EXISTS idx_logs_d ON logs(d, chat_id,
+      ok_reading, ok_focus, ok_screen, ok_tg, ok_wake, ok_sleep)
+    """)
+
+def _m_active_keyset(con):
+    # (active, rowid): iter_active_users идёт по chat_id без сортировки и без скана неактивных
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(active)")
+
+def _m_points(con):
+    # /top и перечитывание таблицы лидеров: активные по очкам без сортировки и без скана users
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_points ON users(active, points DESC, chat_id)")
+
+def _m_fired_slots(con):
+    # какие рассылки уже ушли: воркер и подхвативший его шард лидер не шлют один слот дважды
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS fired_slots (
+      d TEXT NOT NULL,
+      job TEXT NOT NULL,
+      utc_offset INTEGER NOT NULL,
+      shard INTEGER NOT NULL,
+      PRIMARY KEY (d, job, utc_offset, shard)
+    ) WITHOUT ROWID
+    """)
+
+MIGRATIONS = [_m_base, _m_targets_d, _m_log_rollup, _m_indexes, _m_active_keyset, _m_points, _m_fired_slots]
+
+def init_db():
+    with db() as con:
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        for n, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+            with db():  # SAVEPOINT на каждую миграцию
+                migrate(con)
+                con.execute(f"PRAGMA user_version={n}")
 
 def upsert_user(chat_id: int, tz: str, targets: Dict[str, float], deltas: Dict[str, float], start_date: str):
     with db() as con:
@@ -93,104 +195,347 @@ def upsert_user(chat_id: int, tz: str, targets: Dict[str, float], deltas: Dict[s
               targets["wake"], targets["sleep"],
               deltas["reading"], deltas["focus"], deltas["screen"], deltas["tg"],
               deltas["wake"], deltas["sleep"]))
+        _user_changed(chat_id)
+        _rank_set(con, chat_id)
 
-def get_user(chat_id: int) -> Optional[sqlite3.Row]:
-    with db() as con:
-        cur = con.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,))
-        return cur.fetchone()
+def get_user(chat_id: int) -> Optional[UserRow]:
+    u = user_cache.get(chat_id)
+    if u is not None:
+        return u
+    token = user_cache.token()
+    with _read() as con:
+        row = con.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,)).fetchone()
+    if row is None:
+        return None
+    u = UserRow(row)
+    user_cache.put(chat_id, u, token)
+    return u
 
 def all_active_users() -> List[sqlite3.Row]:
-    with db() as con:
+    with _read() as con:
         cur = con.execute("SELECT * FROM users WHERE active=1")
         return cur.fetchall()
 
+def iter_active_users(batch_size: int = 500, columns: Sequence[str] = ("chat_id",),
+                      tzs: Optional[Sequence[str]] = None,
+                      shard: Optional[Tuple[Sequence[int], int]] = None) -> Iterator[List[sqlite3.Row]]:
+    # страницы активных юзеров по keyset (chat_id > последний), только нужные колонки.
+    # Между страницами соединение не держим -> память и блокировки не растут с числом юзеров.
+    # shard=(номера, всего) -> только юзеры этих шардов (см. app.shard.shard_of)
+    bad = set(columns) - set(USER_COLS)
+    if bad:
+        raise ValueError(f"unknown users columns: {sorted(bad)}")
+    cols = ", ".join(dict.fromkeys(("chat_id", *columns)))
+    in_shard, shard_args = "", ()
+    if shard is not None:
+        ids, n = shard
+        if not ids:
+            return
+        in_shard = f" AND ((chat_id % {int(n)}) + {int(n)}) % {int(n)} IN ({', '.join('?' * len(ids))})"
+        shard_args = tuple(ids)
+    for tz in (tzs if tzs is not None else (None,)):
+        where, args = ("active=1 AND tz=?", (tz,)) if tz is not None else ("active=1", ())
+        where, args = where + in_shard, args + shard_args
+        last = None
+        while True:
+            with _read() as con:
+                if last is None:
+                    page = con.execute(f"SELECT {cols} FROM users WHERE {where} ORDER BY chat_id LIMIT ?",
+                                       (*args, batch_size)).fetchall()
+                else:
+                    page = con.execute(f"SELECT {cols} FROM users WHERE {where} AND chat_id>? ORDER BY chat_id LIMIT ?",
+                                       (*args, last, batch_size)).fetchall()
+            if not page:
+                break
+            yield page
+            if len(page) < batch_size:
+                break
+            last = page[-1]["chat_id"]
+
+def active_zones() -> List[str]:
+    with _read() as con:
+        return [r[0] for r in con.execute("SELECT DISTINCT tz FROM users WHERE active=1")]
+
+def set_tz(chat_id: int, tz: str):
+    with db() as con:
+        con.execute("UPDATE users SET tz=? WHERE chat_id=?", (tz, chat_id))
+        _user_changed(chat_id)
+
 def set_active(chat_id: int, active: int):
     with db() as con:
         con.execute("UPDATE users SET active=? WHERE chat_id=?", (active, chat_id))
+        _user_changed(chat_id)
+        if active:
+            _rank_set(con, chat_id)
+        else:
+            pool.after_commit(lambda: leaderboard.set(chat_id, None))
 
-def update_targets_after_day(chat_id: int, inc: Dict[str, bool]):
+def update_targets_after_day(chat_id: int, inc: Dict[str, bool], d: str):
     with db() as con:
         u = con.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,)).fetchone()
-        if not u: return
-        # если цель выполнена -> двигаем по дельте, иначе оставляем
-        def step(val, d, ok, end_is_min=False):
-            if ok:
-                newv = val + d
-                return newv
-            return val
-
-        # применяем
-        new_reading = step(u["reading_target"], u["d_reading"], inc["reading"])
-        new_focus   = step(u["focus_target"],   u["d_focus"],   inc["focus"])
-        new_screen  = step(u["screen_target"],  u["d_screen"],  inc["screen"])
-        new_tg      = step(u["tg_target"],      u["d_tg"],      inc["tg"])
-        new_wake    = step(u["wake_target"],    u["d_wake"],    inc["wake"])
-        new_sleep   = step(u["sleep_target"],   u["d_sleep"],   inc["sleep"])
-
-        # гарантии: tg <= screen
-        if new_tg > new_screen:
-            new_tg = new_screen
-
+        if not u or (u["targets_d"] or "") >= d: return  # по дню d (или позже) цели уже сдвинуты
         con.execute("""
           UPDATE users SET
             reading_target=?, focus_target=?, screen_target=?, tg_target=?,
             wake_target=?, sleep_target=?,
-            day_index=CASE WHEN day_index<60 THEN day_index+1 ELSE day_index END
+            day_index=CASE WHEN day_index<60 THEN day_index+1 ELSE day_index END,
+            targets_d=?
           WHERE chat_id=?
-        """, (new_reading, new_focus, new_screen, new_tg, new_wake, new_sleep, chat_id))
+        """, (*next_targets(u, inc), d, chat_id))
+        _user_changed(chat_id)
+
+def _ok_step(col: str) -> str:
+    return f"{col}_target + CASE WHEN l.ok_{col} THEN d_{col} ELSE 0 END"
+
+# то же, что rules.next_targets, но для всех сразу: один проход UPDATE ... FROM logs
+_ADVANCE = f"""
+UPDATE users SET
+  reading_target={_ok_step("reading")},
+  focus_target={_ok_step("focus")},
+  screen_target={_ok_step("screen")},
+  tg_target=MIN({_ok_step("tg")}, {_ok_step("screen")}),
+  wake_target={_ok_step("wake")},
+  sleep_target={_ok_step("sleep")},
+  day_index=CASE WHEN day_index<60 THEN day_index+1 ELSE day_index END,
+  targets_d=l.d
+FROM logs AS l
+WHERE l.chat_id=users.chat_id AND l.d=? AND (users.targets_d IS NULL OR users.targets_d < l.d)
+"""
+
+def advance_targets(d: str) -> int:
+    # сдвинуть цели всем, у кого есть лог за d и чьи цели по нему ещё не двигались.
+    # Пакетный/админский API (логи, пришедшие мимо опроса): бот его не зовёт, в опросе цели двигает finalize_day
+    with db() as con:
+        n = con.execute(_ADVANCE, (d,)).rowcount
+        pool.after_commit(user_cache.clear)
+        return n
+
+# log_rollup: префиксные суммы logs по каждому юзеру (накопительно на дату d включительно).
+# Сумма за [a, b] = строка на b минус строка до a -> два чтения по ключу вместо скана logs
+ROLLUP_SRC = ("reading_done", "focus_done", "screen_done", "tg_done", "wake_actual", "sleep_actual")
+ROLLUP_COLS = ("c_reading", "c_focus", "c_screen", "c_tg", "c_wake", "c_sleep")
+
+_ROLLUP_BACKFILL = f"""
+INSERT INTO log_rollup (chat_id, d, n, {", ".join(ROLLUP_COLS)})
+SELECT chat_id, d, COUNT(*) OVER w,
+  {", ".join(f"SUM(COALESCE({c},0)) OVER w" for c in ROLLUP_SRC)}
+FROM logs {{where}}
+WINDOW w AS (PARTITION BY chat_id ORDER BY d ROWS UNBOUNDED PRECEDING)
+"""
+
+def _rollup_at(con, chat_id: int, d: str, inclusive: bool = True):
+    op = "<=" if inclusive else "<"
+    return con.execute(f"""
+        SELECT n, {", ".join(ROLLUP_COLS)} FROM log_rollup
+        WHERE chat_id=? AND d {op} ? ORDER BY d DESC LIMIT 1
+    """, (chat_id, d)).fetchone()
 
 def upsert_log(chat_id: int, d: str, **vals):
+    bad = set(vals) - set(LOG_COLS)
+    if bad:
+        raise ValueError(f"unknown logs columns: {sorted(bad)}")
     cols = ", ".join(vals.keys())
     placeholders = ", ".join(["?"]*len(vals))
     updates = ", ".join([f"{k}=excluded.{k}" for k in vals.keys()])
+    pick = f"SELECT {', '.join(ROLLUP_SRC)} FROM logs WHERE chat_id=? AND d=?"
     with db() as con:
+        old = con.execute(pick, (chat_id, d)).fetchone()
         con.execute(f"""
         INSERT INTO logs (chat_id, d, {cols})
         VALUES (?, ?, {placeholders})
         ON CONFLICT(chat_id, d) DO UPDATE SET {updates}
         """, (chat_id, d, *vals.values()))
+        new = con.execute(pick, (chat_id, d)).fetchone()
+        # инкрементально двигаем префиксные суммы: обычно d — последний день, это одна строка
+        diff = [(new[i] or 0) - ((old[i] or 0) if old else 0) for i in range(len(ROLLUP_SRC))]
+        if old is None:
+            base = _rollup_at(con, chat_id, d, inclusive=False)
+            con.execute(f"""
+                INSERT INTO log_rollup (chat_id, d, n, {", ".join(ROLLUP_COLS)})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (chat_id, d, *(tuple(base) if base else (0,) * (len(ROLLUP_COLS) + 1))))
+        con.execute(f"""
+            UPDATE log_rollup SET n=n+?, {", ".join(f"{c}={c}+?" for c in ROLLUP_COLS)}
+            WHERE chat_id=? AND d>=?
+        """, (0 if old else 1, *diff, chat_id, d))
+
+def get_range_stats(chat_id: int, d_from: str, d_to: str) -> Dict[str, Any]:
+    # агрегаты за [d_from, d_to] из log_rollup
+    with _read() as con:
+        hi = _rollup_at(con, chat_id, d_to)
+        lo = _rollup_at(con, chat_id, d_from, inclusive=False)
+    hi = tuple(hi) if hi else (0,) * (len(ROLLUP_COLS) + 1)
+    lo = tuple(lo) if lo else (0,) * (len(ROLLUP_COLS) + 1)
+    days, r, f, sc, tg, w, sl = (a - b for a, b in zip(hi, lo))
+    if days <= 0:
+        return {"days": 0, "sum_reading": None, "sum_focus": None, "sum_screen": None,
+                "sum_tg": None, "avg_wake": None, "avg_sleep": None}
+    return {"days": days, "sum_reading": r, "sum_focus": f, "sum_screen": sc, "sum_tg": tg,
+            "avg_wake": w / days, "avg_sleep": sl / days}
 
 def get_week_stats(chat_id: int, d_from: str, d_to: str) -> Dict[str, Any]:
+    return get_range_stats(chat_id, d_from, d_to)
+
+# --- выгрузка / загрузка (app.export, /export)
+
+def iter_rows(table: str, batch_size: int = 5000, chat_id: int = None) -> Iterator[List[sqlite3.Row]]:
+    # вся таблица (или один юзер) страницами по первичному ключу: каждая страница — отдельное
+    # короткое чтение, WAL-чекпоинт и писатели не ждут выгрузку
+    if table not in EXPORT_COLS:
+        raise ValueError(f"unknown table: {table}")
+    cols = ", ".join(EXPORT_COLS[table])
+    key = "chat_id, d" if table == "logs" else "chat_id"
+    where, args = ("chat_id=?", (chat_id,)) if chat_id is not None else ("1", ())
+    last = None
+    while True:
+        with _read() as con:
+            if last is None:
+                page = con.execute(f"SELECT {cols} FROM {table} WHERE {where} ORDER BY {key} LIMIT ?",
+                                   (*args, batch_size)).fetchall()
+            else:
+                page = con.execute(f"SELECT {cols} FROM {table} WHERE {where} AND ({key}) > ({', '.join('?' * len(last))}) "
+                                   f"ORDER BY {key} LIMIT ?", (*args, *last, batch_size)).fetchall()
+        if not page:
+            return
+        yield page
+        if len(page) < batch_size:
+            return
+        last = tuple(page[-1][k] for k in key.split(", "))
+
+def import_rows(table: str, columns: Sequence[str], rows: Sequence[Sequence]) -> int:
+    # одна пачка = одна транзакция, executemany с upsert по первичному ключу.
+    # Для logs пересобираем log_rollup затронутых юзеров, для обеих — targets_d (как в миграции)
+    if table not in EXPORT_COLS:
+        raise ValueError(f"unknown table: {table}")
+    bad = set(columns) - set(EXPORT_COLS[table])
+    if bad or "chat_id" not in columns or (table == "logs" and "d" not in columns):
+        raise ValueError(f"bad {table} columns: {list(columns)}")
+    key = ("chat_id", "d") if table == "logs" else ("chat_id",)
+    upd = [c for c in columns if c not in key]
+    sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+           f"ON CONFLICT ({', '.join(key)}) DO " + (f"UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in upd)}" if upd else "NOTHING"))
+    ids = sorted({r[columns.index("chat_id")] for r in rows})
+    if not ids:
+        return 0
+    q = ", ".join("?" * len(ids))
     with db() as con:
-        cur = con.execute("""
-        SELECT
-          COUNT(*) as days,
-          SUM(COALESCE(reading_done,0)) as sum_reading,
-          SUM(COALESCE(focus_done,0))   as sum_focus,
-          SUM(COALESCE(screen_done,0))  as sum_screen,
-          SUM(COALESCE(tg_done,0))      as sum_tg,
-          AVG(COALESCE(wake_actual,0))  as avg_wake,
-          AVG(COALESCE(sleep_actual,0)) as avg_sleep
-        FROM logs
-        WHERE chat_id=? AND d BETWEEN ? AND ?;
-        """, (chat_id, d_from, d_to)).fetchone()
-        return dict(cur) if cur else {}
+        con.executemany(sql, rows)
+        if table == "logs":
+            con.execute(f"DELETE FROM log_rollup WHERE chat_id IN ({q})", ids)
+            con.execute(_ROLLUP_BACKFILL.format(where=f"WHERE chat_id IN ({q})"), ids)
+        con.execute(f"UPDATE users SET targets_d=(SELECT MAX(d) FROM logs WHERE logs.chat_id=users.chat_id) "
+                    f"WHERE chat_id IN ({q})", ids)
+        pool.after_commit(user_cache.clear)
+        if table == "users":
+            pool.after_commit(leaderboard.invalidate)
+    return len(rows)
+
+_PUT_SURVEY = """
+INSERT INTO survey (chat_id, step, d) VALUES (?, ?, ?)
+ON CONFLICT(chat_id) DO UPDATE SET step=excluded.step, d=excluded.d,
+    tmp_reading=NULL, tmp_focus=NULL, tmp_screen=NULL, tmp_tg=NULL, tmp_wake=NULL, tmp_sleep=NULL
+"""
 
 def put_survey_state(chat_id: int, step: int, d: str):
     with db() as con:
-        con.execute("""
-        INSERT INTO survey (chat_id, step, d) VALUES (?, ?, ?)
-        ON CONFLICT(chat_id) DO UPDATE SET step=excluded.step, d=excluded.d,
-            tmp_reading=NULL, tmp_focus=NULL, tmp_screen=NULL, tmp_tg=NULL, tmp_wake=NULL, tmp_sleep=NULL
-        """, (chat_id, step, d))
+        con.execute(_PUT_SURVEY, (chat_id, step, d))
 
-def get_survey_state(chat_id: int) -> Optional[sqlite3.Row]:
+def start_surveys(chat_ids: List[int], d: str):
+    # вечерний тик: опросы для всех одним коммитом
     with db() as con:
+        con.executemany(_PUT_SURVEY, [(chat_id, 0, d) for chat_id in chat_ids])
+
+def get_survey_state(chat_id: int) -> Optional[sqlite3.Row]:
+    with _read() as con:
         return con.execute("SELECT * FROM survey WHERE chat_id=?", (chat_id,)).fetchone()
 
 def set_survey_value(chat_id: int, field: str, value: int, next_step: int):
+    if field not in SURVEY_FIELDS:
+        raise ValueError(f"unknown survey field: {field}")
     with db() as con:
         con.execute(f"UPDATE survey SET {field}=?, step=? WHERE chat_id=?", (value, next_step, chat_id))
 
+def load_surveys() -> List[sqlite3.Row]:
+    with _read() as con:
+        return con.execute("SELECT * FROM survey").fetchall()
+
+def save_surveys(rows: List[Tuple]):
+    # write-behind из app.survey: (step, tmp_*..., chat_id, d); удалённые и уже
+    # перезапущенные (другой d) опросы просто не обновятся
+    with db() as con:
+        con.executemany("""
+        UPDATE survey SET step=?, tmp_reading=?, tmp_focus=?, tmp_screen=?, tmp_tg=?, tmp_wake=?, tmp_sleep=?
+        WHERE chat_id=? AND d=?
+        """, rows)
+
 def clear_survey(chat_id: int):
     with db() as con:
         con.execute("DELETE FROM survey WHERE chat_id=?", (chat_id,))
 
+def claim_slot(job: str, d: str, utc_offset: int, shard: int) -> bool:
+    # True -> слот (рассылка job за локальный день d в зонах со смещением utc_offset минут) наш;
+    # False -> его уже разослал другой процесс. Старше недели не храним
+    with db() as con:
+        con.execute("DELETE FROM fired_slots WHERE d < ?", ((date.fromisoformat(d) - timedelta(days=7)).isoformat(),))
+        return con.execute("INSERT OR IGNORE INTO fired_slots (d, job, utc_offset, shard) VALUES (?, ?, ?, ?)",
+                           (d, job, utc_offset, shard)).rowcount == 1
+
 def add_points_and_streak(chat_id: int, delta_pts: int, success_all: bool, any_fail: bool):
     with db() as con:
         u = con.execute("SELECT points, streak FROM users WHERE chat_id=?", (chat_id,)).fetchone()
         if not u: return
-        pts = max(0, u["points"] + delta_pts + (50 if success_all else 0))
-        streak = u["streak"] + 1 if not any_fail else 0
+        pts, streak = next_points(u, delta_pts, success_all, any_fail)
         con.execute("UPDATE users SET points=?, streak=? WHERE chat_id=?", (pts, streak, chat_id))
+        _user_changed(chat_id)
+        pool.after_commit(lambda: leaderboard.update(chat_id, pts))
         return pts, streak
+
+def finalize_day(chat_id: int, d: str, done: Dict[str, int], flags: Dict[str, bool], delta: int):
+    # весь итог дня одной транзакцией: одно чтение users, один UPDATE, лог, чистка опроса
+    with db() as con:
+        u = con.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,)).fetchone()
+        if not u: return
+        success_all = all(flags.values())
+        pts, streak = next_points(u, delta, success_all, not success_all)
+        con.execute("""
+          UPDATE users SET
+            points=?, streak=?,
+            reading_target=?, focus_target=?, screen_target=?, tg_target=?,
+            wake_target=?, sleep_target=?,
+            day_index=CASE WHEN day_index<60 THEN day_index+1 ELSE day_index END,
+            targets_d=?
+          WHERE chat_id=?
+        """, (pts, streak, *next_targets(u, flags), d, chat_id))
+        _user_changed(chat_id)
+        pool.after_commit(lambda: leaderboard.update(chat_id, pts))
+        upsert_log(chat_id, d, **done, **{f"ok_{k}": int(v) for k, v in flags.items()})
+        con.execute("DELETE FROM survey WHERE chat_id=?", (chat_id,))
+        return pts, streak
+
+# --- таблица лидеров
+
+def refresh_ranks() -> int:
+    # перечитать таблицу лидеров, если устарела (первый запрос, импорт, LEADERBOARD_REFRESH_SEC);
+    # один проход по idx_users_points. -> число активных
+    if leaderboard.begin():
+        try:
+            with _read() as con:
+                rows = con.execute("SELECT chat_id, points FROM users WHERE active=1").fetchall()
+        except BaseException:
+            leaderboard.abort()
+            raise
+        leaderboard.load(rows)
+    return len(leaderboard)
+
+def user_rank(chat_id: int) -> Optional[Tuple[int, int]]:
+    # (место, всего активных) из памяти; None -> юзер не активен
+    refresh_ranks()
+    return leaderboard.rank(chat_id)
+
+def top_users(limit: int = 10) -> List[sqlite3.Row]:
+    with _read() as con:
+        return con.execute("SELECT chat_id, points, streak FROM users WHERE active=1 "
+                           "ORDER BY points DESC, chat_id LIMIT ?", (limit,)).fetchall()
+
+# время каждого вызова -> bot_db_query_seconds{fn=...} на /metrics
+metrics.instrument(globals(), __name__, skip=("db", "init_db", "close"))
@@ -0,0 +1,155 @@
+import argparse, asyncio, csv, gzip, io, sys, time
+from typing import BinaryIO, Iterator, List, Sequence, Tuple
+
+from app.storage import EXPORT_COLS, open_store
+
+# выгрузка/загрузка users и logs потоково, пачками по первичному ключу — без копирования bot.db
+# и без долгих блокировок. CSV, CSV.gz или Parquet (нужен pyarrow).
+#   python -m app.export dump logs logs.csv.gz
+#   python -m app.export dump users users.parquet
+#   python -m app.export load logs logs.csv.gz      # upsert, log_rollup пересобирается
+# Хранилище — как у бота (DB_PATH или DATABASE_URL), так что это и миграция SQLite -> Postgres.
+EXPORT_BATCH = 5000
+FORMATS = ("csv", "csv.gz", "parquet")
+
+
+def col_type(col: str):
+    if col in ("d", "tz", "start_date"):
+        return str
+    if col.endswith("_target") or col.startswith("d_"):
+        return float
+    return int
+
+
+def guess_format(path: str) -> str:
+    for fmt in ("csv.gz", "parquet", "csv"):
+        if path.endswith("." + fmt):
+            return fmt
+    return "csv"
+
+
+class CsvWriter:
+    def __init__(self, f: BinaryIO, columns: Sequence[str], gz: bool = False):
+        self._gz = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) if gz else None
+        self._text = io.TextIOWrapper(self._gz or f, encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(columns)
+
+    def write(self, rows: List[Tuple]):
+        self._csv.writerows(rows)
+
+    def close(self):
+        # сам файл не закрываем: это может быть буфер для send_document
+        self._text.flush()
+        self._text.detach()
+        if self._gz is not None:
+            self._gz.close()
+
+
+class ParquetWriter:
+    # одна пачка = одна row group, в памяти не больше пачки
+    def __init__(self, f, columns: Sequence[str]):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise SystemExit("parquet: нужен pyarrow (pip install pyarrow)") from e
+        arrow = {str: pa.string(), float: pa.float64(), int: pa.int64()}
+        self._pa = pa
+        self._columns = list(columns)
+        self._schema = pa.schema([(c, arrow[col_type(c)]) for c in columns])
+        self._w = pq.ParquetWriter(f, self._schema, compression="zstd")
+
+    def write(self, rows: List[Tuple]):
+        cols = list(zip(*rows))
+        self._w.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(c, type=t) for c, t in zip(cols, self._schema.types)], schema=self._schema))
+
+    def close(self):
+        self._w.close()
+
+
+def writer(f, fmt: str, columns: Sequence[str]):
+    if fmt == "parquet":
+        return ParquetWriter(f, columns)
+    return CsvWriter(f, columns, gz=fmt == "csv.gz")
+
+
+async def dump(store, table: str, f: BinaryIO, fmt: str, chat_id: int = None,
+               batch_size: int = EXPORT_BATCH) -> int:
+    w = writer(f, fmt, EXPORT_COLS[table])
+    n = 0
+    try:
+        async for page in store.iter_rows(table, batch_size, chat_id):
+            w.write([tuple(r) for r in page])
+            n += len(page)
+    finally:
+        w.close()
+    return n
+
+
+def read_chunks(path: str, fmt: str, batch_size: int = EXPORT_BATCH) -> Iterator[Tuple[List[str], List[Tuple]]]:
+    # (колонки, пачка строк с нужными типами); пустая строка CSV -> NULL
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        cols = pf.schema_arrow.names
+        for batch in pf.iter_batches(batch_size=batch_size):
+            yield cols, list(zip(*(c.to_pylist() for c in batch.columns)))
+        return
+    opener = gzip.open if fmt == "csv.gz" else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        r = csv.reader(f)
+        cols = next(r)
+        conv = [col_type(c) for c in cols]
+        chunk = []
+        for row in r:
+            chunk.append(tuple(t(v) if v != "" else None for t, v in zip(conv, row)))
+            if len(chunk) >= batch_size:
+                yield cols, chunk
+                chunk = []
+        if chunk:
+            yield cols, chunk
+
+
+async def load(store, table: str, path: str, fmt: str, batch_size: int = EXPORT_BATCH) -> int:
+    n = 0
+    for cols, chunk in read_chunks(path, fmt, batch_size):
+        n += await store.import_rows(table, cols, chunk)
+    return n
+
+
+async def _main(args) -> int:
+    store = open_store()
+    await store.init_db()
+    fmt = args.format or guess_format(args.path)
+    t = time.perf_counter()
+    try:
+        if args.cmd == "dump":
+            if args.path == "-":
+                n = await dump(store, args.table, sys.stdout.buffer, fmt, args.chat, args.batch)
+            else:
+                with open(args.path, "wb") as f:
+                    n = await dump(store, args.table, f, fmt, args.chat, args.batch)
+        else:
+            n = await load(store, args.table, args.path, fmt, args.batch)
+    finally:
+        await store.close()
+    dt = time.perf_counter() - t
+    print(f"{args.cmd} {args.table}: {n} rows in {dt:.1f}s ({n / dt if dt else 0:.0f} rows/s)", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="app.export")
+    p.add_argument("cmd", choices=("dump", "load"))
+    p.add_argument("table", choices=tuple(EXPORT_COLS))
+    p.add_argument("path", help="файл; '-' — stdout (только dump)")
+    p.add_argument("--format", choices=FORMATS, help="по умолчанию — по расширению")
+    p.add_argument("--chat", type=int, help="только этот chat_id (dump)")
+    p.add_argument("--batch", type=int, default=EXPORT_BATCH)
+    return asyncio.run(_main(p.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
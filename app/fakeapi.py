@@ -0,0 +1,114 @@
+import argparse, asyncio, itertools, json, logging, signal, time
+from collections import Counter
+from urllib.parse import parse_qs
+
+from app.httpd import HttpServer
+
+log = logging.getLogger(__name__)
+
+# фейковый Bot API для офлайн-нагрузки: отвечает на /bot<token>/<method> как Telegram, ничего не шлёт.
+#   python -m app.fakeapi --port 8081
+#   BOT_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake python -m app.bot
+# Служебное (app.bench держит фейк отдельным процессом): GET /stats — счётчики вызовов,
+# POST /updates — апдейт в очередь ближайшего getUpdates. --port 0 -> адрес первой строкой в stdout.
+ME = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+      "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+class FakeBotApi(HttpServer):
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, retry_every: int = 0):
+        super().__init__(host, port)
+        self.latency = latency          # имитация RTT до api.telegram.org
+        self.retry_every = retry_every  # каждый N-й sendMessage -> 429 retry_after=1
+        self.calls = Counter()
+        # метод (и "метод@chat_id") -> time.monotonic() первого вызова: часы общие для процессов хоста
+        self.first_at = {}
+        self.updates = []    # отдать боту в ближайший getUpdates
+        self._ids = itertools.count(1)
+        self.route("GET", "/stats", self._stats)
+        self.route("POST", "/updates", self._push)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def _stats(self, headers, body):
+        return 200, json.dumps({"calls": self.calls, "first_at": self.first_at}), "application/json"
+
+    async def _push(self, headers, body):
+        self.updates.append(json.loads(body))
+        return 200, "", "text/plain"
+
+    async def _dispatch(self, method, path, headers, body):
+        # /bot<token>/<method>; путь не фиксирован -> своя маршрутизация вместо route()
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return await super()._dispatch(method, path, headers, body)
+        name = parts[1]
+        self.calls[name] += 1
+        self.first_at.setdefault(name, time.monotonic())
+        params = self._params(headers, body)
+        if params.get("chat_id"):
+            self.first_at.setdefault(f"{name}@{params['chat_id']}", time.monotonic())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if name == "sendMessage" and self.retry_every and self.calls[name] % self.retry_every == 0:
+            return 429, json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                    "parameters": {"retry_after": 1}}), "application/json"
+        if name == "getUpdates":
+            if self.updates:
+                result, self.updates = self.updates, []
+            else:
+                await asyncio.sleep(min(float(params.get("timeout") or 0), 1.0))
+                result = []
+        elif name == "getMe":
+            result = ME
+        elif name in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}), "application/json"
+
+    @staticmethod
+    def _params(headers, body) -> dict:
+        if not body:
+            return {}
+        ctype = headers.get("content-type", "")
+        if ctype.startswith("application/json"):
+            return json.loads(body)
+        if ctype.startswith("multipart/"):
+            return {}  # файлы (sendDocument) не разбираем
+        # PTB шлёт form-urlencoded, нестроковые значения — JSON-строками
+        return {k: v[0] for k, v in parse_qs(body.decode(), keep_blank_values=True).items()}
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        mid = int(params["message_id"]) if params.get("message_id") else next(self._ids)
+        return {"message_id": mid, "date": int(time.time()), "text": params.get("text", ""),
+                "chat": {"id": chat_id, "type": "private"}, "from": ME}
+
+
+async def _serve(args):
+    api = FakeBotApi(args.host, args.port, args.latency_ms / 1000, args.retry_every)
+    await api.start()
+    print(api.url, flush=True)
+    log.info("fake Bot API on %s", api.url)
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await api.stop()
+    # соединения бота (long poll getUpdates) дожидаемся, а не рвём: клиент уже закрылся
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    if tasks:
+        await asyncio.wait(tasks, timeout=2)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(prog="app.fakeapi")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--latency-ms", type=float, default=0)
+    p.add_argument("--retry-every", type=int, default=0)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(p.parse_args()))
@@ -0,0 +1,104 @@
+import asyncio, logging
+from typing import Awaitable, Callable, Dict, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+# минимальный HTTP/1.1 сервер на asyncio: вебхук, /healthz и т.п. без лишних зависимостей
+Response = Tuple[int, Union[bytes, str], str]
+Handler = Callable[[Dict[str, str], bytes], Awaitable[Response]]
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 429: "Too Many Requests",
+           500: "Internal Server Error"}
+
+
+class HttpServer:
+    def __init__(self, host: str, port: int, max_body: int = 1 << 20, read_timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.read_timeout = read_timeout  # на заголовки и на тело: медленный клиент не держит соединение
+        self.routes: Dict[str, Dict[str, Handler]] = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler: Handler):
+        self.routes.setdefault(path, {})[method.upper()] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._conn, self.host, self.port)
+        # порт 0 -> берём выданный системой
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader):
+        # None -> клиент закрыл соединение; ValueError -> кривая строка запроса или строка длиннее лимита
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, version = line.decode("latin-1").split()
+        headers = {}
+        while True:
+            h = await reader.readline()
+            if h in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = h.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        return method, target, version, headers
+
+    async def _conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(self._read_head(reader), self.read_timeout)
+                except (ValueError, asyncio.LimitOverrunError):
+                    await self._reply(writer, 400, b"", "text/plain", False)
+                    break
+                if head is None:
+                    break
+                method, target, version, headers = head
+                keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                size = headers.get("content-length") or "0"
+                if not (size.isascii() and size.isdigit()):
+                    await self._reply(writer, 400, b"", "text/plain", False)
+                    break
+                size = int(size)
+                if size > self.max_body:
+                    await self._reply(writer, 413, b"", "text/plain", False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(size), self.read_timeout) if size else b""
+                status, payload, ctype = await self._dispatch(method, target.split("?", 1)[0], headers, body)
+                await self._reply(writer, status, payload, ctype, keep)
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body) -> Response:
+        by_method = self.routes.get(path)
+        if by_method is None:
+            return 404, b"", "text/plain"
+        handler = by_method.get(method.upper())
+        if handler is None:
+            return 405, b"", "text/plain"
+        try:
+            return await handler(headers, body)
+        except Exception:
+            log.exception("http handler %s %s failed", method, path)
+            return 500, b"", "text/plain"
+
+    async def _reply(self, writer, status: int, payload, ctype: str, keep: bool):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
@@ -0,0 +1,224 @@
+import bisect, functools, inspect, threading, time
+from typing import Callable, Dict, Sequence, Tuple
+
+# метрики в текстовом формате Prometheus без зависимостей: счётчики, gauge, гистограммы с метками.
+# Отдаются на GET /metrics (METRICS_HOST:METRICS_PORT, в обоих режимах).
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _esc(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt(name: str, names: Sequence[str], values: Tuple, value: float) -> str:
+    lbl = ",".join(f'{k}="{_esc(v)}"' for k, v in zip(names, values))
+    return f"{name}{{{lbl}}} {value:g}" if lbl else f"{name} {value:g}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # db-функции пишут из потоков executor
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, n: float = 1, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + n
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def lines(self):
+        yield from super().lines()
+        for k, v in sorted(self._values.items()):
+            yield _fmt(self.name, self.labels, k, v)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        # значение считается в момент запроса /metrics
+        self._functions[self._key(labels)] = fn
+
+    def lines(self):
+        yield from super().lines()
+        values = dict(self._values)
+        for k, fn in self._functions.items():
+            try:
+                values[k] = float(fn())
+            except Exception:
+                continue
+        for k, v in sorted(values.items()):
+            yield _fmt(self.name, self.labels, k, v)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *a, buckets: Sequence[float] = BUCKETS, **kw):
+        super().__init__(*a, **kw)
+        self.buckets = tuple(buckets)
+        # ключ меток -> [счётчики по корзинам (+Inf последняя), сумма, количество]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, v: float, **labels):
+        k = self._key(labels)
+        i = bisect.bisect_left(self.buckets, v)
+        with self._lock:
+            st = self._values.get(k)
+            if st is None:
+                st = self._values[k] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            st[0][i] += 1
+            st[1] += v
+            st[2] += 1
+
+    def lines(self):
+        yield from super().lines()
+        names = self.labels + ("le",)
+        with self._lock:
+            items = sorted((k, (list(c), s, n)) for k, (c, s, n) in self._values.items())
+        for k, (counts, total, n) in items:
+            acc = 0
+            for le, c in zip((*self.buckets, "+Inf"), counts):
+                acc += c
+                yield _fmt(self.name + "_bucket", names, (*k, f"{le:g}" if le != "+Inf" else le), acc)
+            yield _fmt(self.name + "_sum", self.labels, k, total)
+            yield _fmt(self.name + "_count", self.labels, k, n)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, m):
+        self.metrics.append(m)
+        return m
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets=buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics for line in m.lines()) + "\n"
+
+
+REGISTRY = Registry()
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Время хендлеров бота", ("handler",))
+DB_SECONDS = REGISTRY.histogram("bot_db_query_seconds", "Время вызовов хранилища (в потоке executor)", ("fn",))
+JOB_LAG = REGISTRY.histogram("bot_job_lag_seconds", "Фактический запуск минус плановый", ("job",))
+TG_ERRORS = REGISTRY.counter("bot_telegram_errors_total", "Ошибки Bot API по типу", ("kind",))
+TG_RETRY_AFTER = REGISTRY.counter("bot_telegram_retry_after_total", "Ответы 429 RetryAfter")
+SURVEYS_ACTIVE = REGISTRY.gauge("bot_surveys_active", "Незавершённые вечерние опросы в памяти")
+BROADCAST = REGISTRY.gauge("bot_broadcast", "Состояние очереди рассылки", ("stat",))
+USER_CACHE = REGISTRY.gauge("bot_user_cache", "LRU-кэш get_user", ("stat",))
+BACKUP = REGISTRY.gauge("bot_backup", "Последний онлайн-бэкап SQLite", ("stat",))
+STARTUP = REGISTRY.gauge("bot_startup_seconds", "Фазы старта от начала импорта app.bot", ("phase",))
+
+
+def timed(hist: Histogram, name: str = None):
+    # декоратор: время вызова -> hist{<первая метка>=name}; поведение функции не меняется.
+    # Для генераторов меряется каждый next() (страница iter_active_users и т.п.)
+    def wrap(fn):
+        label = {hist.labels[0]: name or fn.__name__}
+        clock = time.perf_counter
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def call(*a, **kw):
+                t = clock()
+                try:
+                    return await fn(*a, **kw)
+                finally:
+                    hist.observe(clock() - t, **label)
+        elif inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def call(*a, **kw):
+                it = fn(*a, **kw)
+                try:
+                    while True:
+                        t = clock()
+                        try:
+                            item = await it.__anext__()
+                        except StopAsyncIteration:
+                            return
+                        finally:
+                            hist.observe(clock() - t, **label)
+                        yield item
+                finally:
+                    await it.aclose()
+        elif inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def call(*a, **kw):
+                it = fn(*a, **kw)
+                try:
+                    while True:
+                        t = clock()
+                        try:
+                            item = next(it)
+                        except StopIteration:
+                            return
+                        finally:
+                            hist.observe(clock() - t, **label)
+                        yield item
+                finally:
+                    it.close()
+        else:
+            @functools.wraps(fn)
+            def call(*a, **kw):
+                t = clock()
+                try:
+                    return fn(*a, **kw)
+                finally:
+                    hist.observe(clock() - t, **label)
+        return call
+    return wrap
+
+
+def instrument(namespace, module: str, hist: Histogram = DB_SECONDS, skip: Sequence[str] = ()):
+    # обернуть все публичные функции модуля (globals()) или методы класса в timed —
+    # вызовы изнутри модуля тоже меряются
+    items = namespace if isinstance(namespace, dict) else vars(namespace)
+    for n, f in list(items.items()):
+        if inspect.isfunction(f) and f.__module__ == module and not n.startswith("_") and n not in skip:
+            if isinstance(namespace, dict):
+                namespace[n] = timed(hist, n)(f)
+            else:
+                setattr(namespace, n, timed(hist, n)(f))
+
+
+async def handle(headers, body):
+    return 200, REGISTRY.render(), "text/plain; version=0.0.4"
@@ -0,0 +1,390 @@
+import os
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app import metrics
+from app.ranks import Leaderboard
+from app.rules import next_targets, next_points
+from app.storage import EXPORT_COLS, LOG_COLS, USER_COLS
+from app.survey import FIELDS as SURVEY_FIELDS
+
+# PostgreSQL-бэкенд app.storage.Store на asyncpg: общий пул соединений, можно несколько реплик бота.
+# asyncpg — опциональная зависимость (pip install asyncpg), нужна только при DATABASE_URL=postgresql://
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+
+# миграции: номер = индекс + 1, только дописывать в конец
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+      chat_id BIGINT PRIMARY KEY,
+      tz TEXT NOT NULL,
+      active INTEGER NOT NULL DEFAULT 0,
+      start_date TEXT,
+      day_index INTEGER NOT NULL DEFAULT 0,
+      reading_target DOUBLE PRECISION,
+      focus_target DOUBLE PRECISION,
+      screen_target DOUBLE PRECISION,
+      tg_target DOUBLE PRECISION,
+      wake_target DOUBLE PRECISION,
+      sleep_target DOUBLE PRECISION,
+      d_reading DOUBLE PRECISION, d_focus DOUBLE PRECISION, d_screen DOUBLE PRECISION,
+      d_tg DOUBLE PRECISION, d_wake DOUBLE PRECISION, d_sleep DOUBLE PRECISION,
+      points INTEGER NOT NULL DEFAULT 0,
+      streak INTEGER NOT NULL DEFAULT 0,
+      targets_d TEXT
+    );
+    CREATE TABLE IF NOT EXISTS logs (
+      chat_id BIGINT NOT NULL,
+      d TEXT NOT NULL,
+      reading_done INTEGER, focus_done INTEGER, screen_done INTEGER, tg_done INTEGER,
+      wake_actual INTEGER, sleep_actual INTEGER,
+      ok_reading INTEGER, ok_focus INTEGER, ok_screen INTEGER, ok_tg INTEGER,
+      ok_wake INTEGER, ok_sleep INTEGER,
+      PRIMARY KEY (chat_id, d)
+    );
+    CREATE TABLE IF NOT EXISTS survey (
+      chat_id BIGINT PRIMARY KEY,
+      step INTEGER NOT NULL,
+      d TEXT NOT NULL,
+      tmp_reading INTEGER, tmp_focus INTEGER, tmp_screen INTEGER, tmp_tg INTEGER,
+      tmp_wake INTEGER, tmp_sleep INTEGER
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_users_active_tz ON users(active, tz, chat_id);
+    CREATE INDEX IF NOT EXISTS idx_users_active ON users(active, chat_id);
+    CREATE INDEX IF NOT EXISTS idx_logs_d ON logs(d, chat_id)
+      INCLUDE (ok_reading, ok_focus, ok_screen, ok_tg, ok_wake, ok_sleep);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_users_points ON users(active, points DESC, chat_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS fired_slots (
+      d TEXT NOT NULL,
+      job TEXT NOT NULL,
+      utc_offset INTEGER NOT NULL,
+      shard INTEGER NOT NULL,
+      PRIMARY KEY (d, job, utc_offset, shard)
+    );
+    """,
+]
+
+
+def _ok_step(col: str) -> str:
+    return f"u.{col}_target + CASE WHEN COALESCE(l.ok_{col}, 0) <> 0 THEN u.d_{col} ELSE 0 END"
+
+
+_ADVANCE = f"""
+UPDATE users AS u SET
+  reading_target={_ok_step("reading")},
+  focus_target={_ok_step("focus")},
+  screen_target={_ok_step("screen")},
+  tg_target=LEAST({_ok_step("tg")}, {_ok_step("screen")}),
+  wake_target={_ok_step("wake")},
+  sleep_target={_ok_step("sleep")},
+  day_index=CASE WHEN u.day_index<60 THEN u.day_index+1 ELSE u.day_index END,
+  targets_d=l.d
+FROM logs AS l
+WHERE l.chat_id=u.chat_id AND l.d=$1 AND (u.targets_d IS NULL OR u.targets_d < l.d)
+"""
+
+_PUT_SURVEY = """
+INSERT INTO survey (chat_id, step, d) VALUES ($1, $2, $3)
+ON CONFLICT (chat_id) DO UPDATE SET step=EXCLUDED.step, d=EXCLUDED.d,
+    tmp_reading=NULL, tmp_focus=NULL, tmp_screen=NULL, tmp_tg=NULL, tmp_wake=NULL, tmp_sleep=NULL
+"""
+
+_UPDATE_USER_DAY = """
+UPDATE users SET
+  reading_target=$1, focus_target=$2, screen_target=$3, tg_target=$4,
+  wake_target=$5, sleep_target=$6,
+  day_index=CASE WHEN day_index<60 THEN day_index+1 ELSE day_index END
+"""
+
+
+class PgStore:
+    def __init__(self, dsn: str, schema: str = None):
+        self.dsn = dsn
+        self.schema = schema
+        self._pool = None
+        # своя таблица лидеров на процесс; записи других реплик — через LEADERBOARD_REFRESH_SEC
+        self.leaderboard = Leaderboard()
+
+    async def init_db(self):
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError("DATABASE_URL указывает на PostgreSQL, нужен пакет asyncpg") from e
+        settings = {"search_path": self.schema} if self.schema else None
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX,
+                                               server_settings=settings)
+        async with self._pool.acquire() as con, con.transaction():
+            # несколько реплик стартуют одновременно -> мигрирует одна
+            await con.execute("SELECT pg_advisory_xact_lock(hashtext('discipline-bot-migrations'))")
+            await con.execute("CREATE TABLE IF NOT EXISTS schema_version (v INTEGER NOT NULL)")
+            v = await con.fetchval("SELECT v FROM schema_version")
+            if v is None:
+                await con.execute("INSERT INTO schema_version VALUES (0)")
+                v = 0
+            for sql in MIGRATIONS[v:]:
+                await con.execute(sql)
+            await con.execute("UPDATE schema_version SET v=$1", len(MIGRATIONS))
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {}
+
+    # --- users
+
+    async def upsert_user(self, chat_id: int, tz: str, targets: Dict[str, float],
+                          deltas: Dict[str, float], start_date: str):
+        pts = await self._pool.fetchval("""
+        INSERT INTO users (chat_id, tz, active, start_date, day_index,
+          reading_target, focus_target, screen_target, tg_target, wake_target, sleep_target,
+          d_reading, d_focus, d_screen, d_tg, d_wake, d_sleep
+        )
+        VALUES ($1, $2, 1, $3, 0, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
+        ON CONFLICT (chat_id) DO UPDATE SET
+          active=1, tz=EXCLUDED.tz, start_date=EXCLUDED.start_date,
+          reading_target=EXCLUDED.reading_target, focus_target=EXCLUDED.focus_target,
+          screen_target=EXCLUDED.screen_target, tg_target=EXCLUDED.tg_target,
+          wake_target=EXCLUDED.wake_target, sleep_target=EXCLUDED.sleep_target,
+          d_reading=EXCLUDED.d_reading, d_focus=EXCLUDED.d_focus,
+          d_screen=EXCLUDED.d_screen, d_tg=EXCLUDED.d_tg,
+          d_wake=EXCLUDED.d_wake, d_sleep=EXCLUDED.d_sleep
+        RETURNING points
+        """, chat_id, tz, start_date,
+            targets["reading"], targets["focus"], targets["screen"], targets["tg"],
+            targets["wake"], targets["sleep"],
+            deltas["reading"], deltas["focus"], deltas["screen"], deltas["tg"],
+            deltas["wake"], deltas["sleep"])
+        self.leaderboard.set(chat_id, pts)
+
+    async def get_user(self, chat_id: int):
+        return await self._pool.fetchrow("SELECT * FROM users WHERE chat_id=$1", chat_id)
+
+    async def all_active_users(self):
+        return await self._pool.fetch("SELECT * FROM users WHERE active=1")
+
+    async def iter_active_users(self, batch_size: int = 500, columns: Sequence[str] = ("chat_id",),
+                                tzs: Optional[Sequence[str]] = None,
+                                shard: Optional[Tuple[Sequence[int], int]] = None):
+        bad = set(columns) - set(USER_COLS)
+        if bad:
+            raise ValueError(f"unknown users columns: {sorted(bad)}")
+        cols = ", ".join(dict.fromkeys(("chat_id", *columns)))
+        in_shard, shard_args = "", ()
+        if shard is not None:
+            ids, n = shard
+            if not ids:
+                return
+            in_shard, shard_args = f" AND ((chat_id % {int(n)}) + {int(n)}) % {int(n)} = ANY($4::int[])", (list(ids),)
+        for tz in (tzs if tzs is not None else (None,)):
+            # $3 занят поясом всегда (NULL, если без фильтра) — номера параметров не плывут
+            where = ("active=1 AND tz=$3" if tz is not None else "active=1 AND $3::text IS NULL") + in_shard
+            args = (tz, *shard_args)
+            last = None
+            while True:
+                # -2^63: меньше любого chat_id, один и тот же запрос для первой и следующих страниц
+                page = await self._pool.fetch(
+                    f"SELECT {cols} FROM users WHERE {where} AND chat_id>$1 ORDER BY chat_id LIMIT $2",
+                    last if last is not None else -(1 << 63), batch_size, *args)
+                if not page:
+                    break
+                yield page
+                if len(page) < batch_size:
+                    break
+                last = page[-1]["chat_id"]
+
+    async def active_zones(self) -> List[str]:
+        return [r[0] for r in await self._pool.fetch("SELECT DISTINCT tz FROM users WHERE active=1")]
+
+    async def set_tz(self, chat_id: int, tz: str):
+        await self._pool.execute("UPDATE users SET tz=$1 WHERE chat_id=$2", tz, chat_id)
+
+    async def set_active(self, chat_id: int, active: int):
+        pts = await self._pool.fetchval("UPDATE users SET active=$1 WHERE chat_id=$2 RETURNING points",
+                                        active, chat_id)
+        if pts is not None:
+            self.leaderboard.set(chat_id, pts if active else None)
+
+    # --- итоги дня
+
+    async def update_targets_after_day(self, chat_id: int, inc: Dict[str, bool], d: str):
+        async with self._pool.acquire() as con, con.transaction():
+            u = await con.fetchrow("SELECT * FROM users WHERE chat_id=$1 FOR UPDATE", chat_id)
+            if not u or (u["targets_d"] or "") >= d: return
+            await con.execute(_UPDATE_USER_DAY + ", targets_d=$7 WHERE chat_id=$8", *next_targets(u, inc), d, chat_id)
+
+    async def advance_targets(self, d: str) -> int:
+        status = await self._pool.execute(_ADVANCE, d)
+        return int(status.split()[-1])
+
+    async def add_points_and_streak(self, chat_id: int, delta_pts: int, success_all: bool, any_fail: bool):
+        async with self._pool.acquire() as con, con.transaction():
+            u = await con.fetchrow("SELECT points, streak FROM users WHERE chat_id=$1 FOR UPDATE", chat_id)
+            if not u: return
+            pts, streak = next_points(u, delta_pts, success_all, any_fail)
+            await con.execute("UPDATE users SET points=$1, streak=$2 WHERE chat_id=$3", pts, streak, chat_id)
+        self.leaderboard.update(chat_id, pts)  # после COMMIT
+        return pts, streak
+
+    async def finalize_day(self, chat_id: int, d: str, done: Dict[str, int], flags: Dict[str, bool], delta: int):
+        async with self._pool.acquire() as con, con.transaction():
+            u = await con.fetchrow("SELECT * FROM users WHERE chat_id=$1 FOR UPDATE", chat_id)
+            if not u: return
+            success_all = all(flags.values())
+            pts, streak = next_points(u, delta, success_all, not success_all)
+            await con.execute(_UPDATE_USER_DAY + ", points=$7, streak=$8, targets_d=$9 WHERE chat_id=$10",
+                              *next_targets(u, flags), pts, streak, d, chat_id)
+            await self._upsert_log(con, chat_id, d, {**done, **{f"ok_{k}": int(v) for k, v in flags.items()}})
+            await con.execute("DELETE FROM survey WHERE chat_id=$1", chat_id)
+        self.leaderboard.update(chat_id, pts)
+        return pts, streak
+
+    # --- таблица лидеров
+
+    async def refresh_ranks(self) -> int:
+        if self.leaderboard.begin():
+            try:
+                rows = await self._pool.fetch("SELECT chat_id, points FROM users WHERE active=1")
+            except BaseException:
+                self.leaderboard.abort()
+                raise
+            self.leaderboard.load(rows)
+        return len(self.leaderboard)
+
+    async def user_rank(self, chat_id: int) -> Optional[Tuple[int, int]]:
+        await self.refresh_ranks()
+        return self.leaderboard.rank(chat_id)
+
+    async def top_users(self, limit: int = 10):
+        return await self._pool.fetch("SELECT chat_id, points, streak FROM users WHERE active=1 "
+                                      "ORDER BY points DESC, chat_id LIMIT $1", limit)
+
+    # --- логи
+
+    async def _upsert_log(self, con, chat_id: int, d: str, vals: Dict[str, Any]):
+        bad = set(vals) - set(LOG_COLS)
+        if bad:
+            raise ValueError(f"unknown logs columns: {sorted(bad)}")
+        keys = list(vals)
+        await con.execute(f"""
+        INSERT INTO logs (chat_id, d, {", ".join(keys)})
+        VALUES ($1, $2, {", ".join(f"${i + 3}" for i in range(len(keys)))})
+        ON CONFLICT (chat_id, d) DO UPDATE SET {", ".join(f"{k}=EXCLUDED.{k}" for k in keys)}
+        """, chat_id, d, *vals.values())
+
+    async def upsert_log(self, chat_id: int, d: str, **vals):
+        await self._upsert_log(self._pool, chat_id, d, vals)
+
+    async def get_range_stats(self, chat_id: int, d_from: str, d_to: str) -> Dict[str, Any]:
+        # в Postgres это диапазон по первичному ключу (chat_id, d) — отдельный rollup не нужен
+        row = await self._pool.fetchrow("""
+        SELECT
+          COUNT(*) AS days,
+          SUM(COALESCE(reading_done,0)) AS sum_reading,
+          SUM(COALESCE(focus_done,0))   AS sum_focus,
+          SUM(COALESCE(screen_done,0))  AS sum_screen,
+          SUM(COALESCE(tg_done,0))      AS sum_tg,
+          AVG(COALESCE(wake_actual,0))::float8  AS avg_wake,
+          AVG(COALESCE(sleep_actual,0))::float8 AS avg_sleep
+        FROM logs
+        WHERE chat_id=$1 AND d BETWEEN $2 AND $3
+        """, chat_id, d_from, d_to)
+        return dict(row)
+
+    async def get_week_stats(self, chat_id: int, d_from: str, d_to: str) -> Dict[str, Any]:
+        return await self.get_range_stats(chat_id, d_from, d_to)
+
+    # --- выгрузка / загрузка
+
+    async def iter_rows(self, table: str, batch_size: int = 5000, chat_id: int = None):
+        if table not in EXPORT_COLS:
+            raise ValueError(f"unknown table: {table}")
+        cols = ", ".join(EXPORT_COLS[table])
+        key = ("chat_id", "d") if table == "logs" else ("chat_id",)
+        where, args = ("chat_id=$1", [chat_id]) if chat_id is not None else ("TRUE", [])
+        last = None
+        while True:
+            keyset = ""
+            if last is not None:
+                keyset = f" AND ({', '.join(key)}) > ({', '.join(f'${len(args) + i + 1}' for i in range(len(key)))})"
+            page = await self._pool.fetch(
+                f"SELECT {cols} FROM {table} WHERE {where}{keyset} ORDER BY {', '.join(key)} "
+                f"LIMIT {int(batch_size)}", *args, *(last or ()))
+            if not page:
+                return
+            yield page
+            if len(page) < batch_size:
+                return
+            last = tuple(page[-1][k] for k in key)
+
+    async def import_rows(self, table: str, columns: Sequence[str], rows: Sequence[Sequence]) -> int:
+        if table not in EXPORT_COLS:
+            raise ValueError(f"unknown table: {table}")
+        if set(columns) - set(EXPORT_COLS[table]) or "chat_id" not in columns or (table == "logs" and "d" not in columns):
+            raise ValueError(f"bad {table} columns: {list(columns)}")
+        key = ("chat_id", "d") if table == "logs" else ("chat_id",)
+        upd = [c for c in columns if c not in key]
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+               f"VALUES ({', '.join(f'${i + 1}' for i in range(len(columns)))}) ON CONFLICT ({', '.join(key)}) DO "
+               + (f"UPDATE SET {', '.join(f'{c}=EXCLUDED.{c}' for c in upd)}" if upd else "NOTHING"))
+        ids = sorted({r[columns.index("chat_id")] for r in rows})
+        if not ids:
+            return 0
+        async with self._pool.acquire() as con, con.transaction():
+            await con.executemany(sql, rows)
+            await con.execute("UPDATE users SET targets_d=(SELECT MAX(d) FROM logs WHERE logs.chat_id=users.chat_id) "
+                              "WHERE chat_id = ANY($1::bigint[])", ids)
+        if table == "users":
+            self.leaderboard.invalidate()
+        return len(rows)
+
+    # --- опрос
+
+    async def put_survey_state(self, chat_id: int, step: int, d: str):
+        await self._pool.execute(_PUT_SURVEY, chat_id, step, d)
+
+    async def start_surveys(self, chat_ids: List[int], d: str):
+        await self._pool.executemany(_PUT_SURVEY, [(chat_id, 0, d) for chat_id in chat_ids])
+
+    async def get_survey_state(self, chat_id: int):
+        return await self._pool.fetchrow("SELECT * FROM survey WHERE chat_id=$1", chat_id)
+
+    async def set_survey_value(self, chat_id: int, field: str, value: int, next_step: int):
+        if field not in SURVEY_FIELDS:
+            raise ValueError(f"unknown survey field: {field}")
+        await self._pool.execute(f"UPDATE survey SET {field}=$1, step=$2 WHERE chat_id=$3",
+                                 value, next_step, chat_id)
+
+    async def load_surveys(self):
+        return await self._pool.fetch("SELECT * FROM survey")
+
+    async def save_surveys(self, rows: List[Tuple]):
+        await self._pool.executemany("""
+        UPDATE survey SET step=$1, tmp_reading=$2, tmp_focus=$3, tmp_screen=$4, tmp_tg=$5,
+          tmp_wake=$6, tmp_sleep=$7
+        WHERE chat_id=$8 AND d=$9
+        """, rows)
+
+    async def clear_survey(self, chat_id: int):
+        await self._pool.execute("DELETE FROM survey WHERE chat_id=$1", chat_id)
+
+    async def claim_slot(self, job: str, d: str, utc_offset: int, shard: int) -> bool:
+        async with self._pool.acquire() as con, con.transaction():
+            await con.execute("DELETE FROM fired_slots WHERE d < $1",
+                              (date.fromisoformat(d) - timedelta(days=7)).isoformat())
+            status = await con.execute("INSERT INTO fired_slots (d, job, utc_offset, shard) VALUES ($1, $2, $3, $4) "
+                                       "ON CONFLICT DO NOTHING", d, job, utc_offset, shard)
+        return status == "INSERT 0 1"
+
+
+# время каждого запроса -> bot_db_query_seconds{fn=...}, как у app.db
+metrics.instrument(PgStore, __name__, skip=("init_db", "close", "cache_stats"))
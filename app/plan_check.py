@@ -0,0 +1,143 @@
+import argparse, inspect, os, random, sqlite3, sys, tempfile
+
+# EXPLAIN QUERY PLAN для каждого запроса app.db на синтетической базе.
+# Падает (exit 1), если какой-то запрос делает полный скан таблицы.
+#   python -m app.plan_check --users 100000
+
+# функции, которые не ходят в данные или сканируют намеренно
+SKIP = {"db", "close", "init_db"}
+ALLOW_SCAN = {
+    "load_surveys": ("survey",),  # загрузка всех активных опросов при старте
+    "iter_rows": ("logs", "users"),  # выгрузка: первая страница идёт по PK с LIMIT
+}
+
+D0 = "2024-01-01"
+DAYS = [f"2024-01-{i:02d}" for i in range(1, 8)]
+
+
+def _calls(db):
+    t = {"reading": 20.0, "focus": 30.0, "screen": 180.0, "tg": 90.0, "wake": 510.0, "sleep": 30.0}
+    dl = {k: 1.0 for k in t}
+    ok = {k: True for k in t}
+    done = {"reading_done": 30, "focus_done": 40, "screen_done": 100, "tg_done": 20,
+            "wake_actual": 420, "sleep_actual": 1400}
+    return {
+        "upsert_user": (7, "Europe/Amsterdam", t, dl, D0),
+        "get_user": (7,),
+        "all_active_users": (),
+        "iter_active_users": (1000, ("tz", "start_date"), ["Europe/Amsterdam", "Asia/Tokyo"], ([0, 2], 4)),
+        "active_zones": (),
+        "set_tz": (7, "Europe/Amsterdam"),
+        "set_active": (7, 1),
+        "update_targets_after_day": (7, ok, DAYS[-1]),
+        "advance_targets": (DAYS[-1],),
+        "upsert_log": (7, DAYS[-1]),
+        "get_range_stats": (7, DAYS[0], DAYS[-1]),
+        "get_week_stats": (7, DAYS[0], DAYS[-1]),
+        "put_survey_state": (7, 0, DAYS[-1]),
+        "start_surveys": ([7, 8, 9], DAYS[-1]),
+        "get_survey_state": (7,),
+        "set_survey_value": (7, "tmp_reading", 10, 1),
+        "load_surveys": (),
+        "save_surveys": ([(1, 10, None, None, None, None, None, 7, DAYS[-1])],),
+        "clear_survey": (7,),
+        "claim_slot": ("evening_job", DAYS[-1], 180, 0),
+        "iter_rows": ("logs", 1000),
+        "import_rows": ("logs", ("chat_id", "d", "reading_done"), [(7, DAYS[-1], 5), (17, DAYS[0], 3)]),
+        "add_points_and_streak": (7, 10, False, True),
+        "finalize_day": (7, DAYS[-1], done, ok, 30),
+        "refresh_ranks": (),
+        "user_rank": (7,),
+        "top_users": (10,),
+    }
+
+
+def _kwargs(name):
+    if name == "upsert_log":
+        return {"reading_done": 5, "ok_reading": 1}
+    return {}
+
+
+def seed(db, users: int):
+    rnd = random.Random(1)
+    zones = ["Europe/Amsterdam", "Europe/Moscow", "America/New_York", "Asia/Tokyo"]
+    with db.db() as con:
+        con.executemany("""
+            INSERT INTO users (chat_id, tz, active, start_date, day_index,
+              reading_target, focus_target, screen_target, tg_target, wake_target, sleep_target,
+              d_reading, d_focus, d_screen, d_tg, d_wake, d_sleep, points, streak)
+            VALUES (?, ?, ?, ?, 0, 20, 30, 180, 90, 510, 30, 1, 2, -2, -1, -1.5, -1.5, ?, 0)
+        """, ((c, rnd.choice(zones), int(rnd.random() < 0.8), D0, rnd.randint(0, 3000))
+              for c in range(1, users + 1)))
+    # неделя логов у каждого десятого — через upsert_log, чтобы наполнилась и log_rollup
+    for c in range(1, users + 1, 10):
+        for d in DAYS:
+            db.upsert_log(c, d, reading_done=rnd.randint(0, 90), focus_done=rnd.randint(0, 180),
+                          ok_reading=1, ok_focus=0)
+    db.start_surveys(list(range(1, users + 1, 50)), DAYS[-1])
+    with db.db() as con:
+        con.execute("ANALYZE")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="app.plan_check")
+    p.add_argument("--users", type=int, default=100000)
+    args = p.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix="plan-check-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "bot.db")
+    from app import db  # DB_PATH читается при импорте
+
+    db.init_db()
+    seed(db, args.users)
+
+    calls = _calls(db)
+    public = {n for n, f in inspect.getmembers(db, inspect.isfunction)
+              if f.__module__ == db.__name__ and not n.startswith("_")} - SKIP
+    missing = public - set(calls)
+    if missing:
+        print(f"no plan-check call for: {', '.join(sorted(missing))}")
+        return 1
+
+    # ловим все реально выполненные SQL (с подставленными значениями)
+    captured = []
+    connect = db.pool._connect
+
+    def traced(*a, **kw):
+        con = connect(*a, **kw)
+        con.set_trace_callback(captured.append)
+        return con
+
+    db.pool.close()
+    db.pool._connect = traced
+
+    probe = sqlite3.connect(db.DB_PATH)
+    failed = 0
+    for name in sorted(calls):
+        captured.clear()
+        res = getattr(db, name)(*calls[name], **_kwargs(name))
+        if inspect.isgenerator(res):
+            for _ in zip(range(3), res):  # пара страниц, чтобы попал и keyset-запрос
+                pass
+        db.user_cache.clear()
+        for sql in captured:
+            head = sql.lstrip().split(None, 1)[0].upper()
+            if head not in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+                continue
+            plan = [r[3] for r in probe.execute("EXPLAIN QUERY PLAN " + sql)]
+            # SCAN (subquery-N) — проход по уже выбранным строкам подзапроса, не по таблице
+            scans = [s for s in plan if s.startswith("SCAN ") and not s.startswith("SCAN (subquery-")
+                     and s.split()[1] not in ALLOW_SCAN.get(name, ())]
+            status = "FAIL" if scans else "ok"
+            failed += bool(scans)
+            print(f"[{status}] {name}: {' | '.join(plan) or '-'}")
+            if scans:
+                print("       " + " ".join(sql.split())[:200])
+    probe.close()
+    db.close()
+    print(f"{failed} full scan(s)" if failed else "no full scans")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import os, queue, sqlite3, threading
+from contextlib import contextmanager
+from typing import Callable, List
+
+# долгоживущие соединения: один писатель + небольшой пул читателей (WAL)
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",    # ~16 МБ страниц
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class Pool:
+    def __init__(self, path: str, readers: int = 4, statements: int = 256, synchronous: str = "NORMAL"):
+        self.path = path
+        # писатель: NORMAL в WAL -> fsync только на чекпоинте, COMMIT виден сразу, но при падении ОС
+        # последние транзакции могут пропасть; FULL -> fsync WAL на каждом COMMIT
+        self.synchronous = synchronous
+        self.readers = readers
+        self.statements = statements
+        self._writer = None
+        self._wlock = threading.RLock()
+        self._depth = 0
+        self._after: List[Callable[[], None]] = []
+        self._owner = None
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._olock = threading.Lock()
+        self.commits = 0  # внешние COMMIT (для бенчмарков и метрик)
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        # isolation_level=None: транзакциями управляем сами (BEGIN/SAVEPOINT)
+        con = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                              cached_statements=self.statements)
+        con.row_factory = sqlite3.Row
+        for p in PRAGMAS:
+            con.execute(p)
+        if readonly:
+            con.execute("PRAGMA query_only=1")
+        else:
+            con.execute(f"PRAGMA synchronous={self.synchronous}")
+        return con
+
+    def set_synchronous(self, mode: str):
+        with self._wlock:
+            self.synchronous = mode
+            if self._writer is not None:
+                self._writer.execute(f"PRAGMA synchronous={mode}")
+
+    @contextmanager
+    def write(self):
+        # одна транзакция писателя на всё; вложенные вызовы -> SAVEPOINT
+        with self._wlock:
+            if self._writer is None:
+                self._writer = self._connect()
+            con = self._writer
+            depth = self._depth
+            hooks = len(self._after)
+            if depth == 0:
+                con.execute("BEGIN IMMEDIATE")
+                self._owner = threading.get_ident()
+            else:
+                con.execute(f"SAVEPOINT sp{depth}")
+            self._depth = depth + 1
+            try:
+                yield con
+            except BaseException:
+                self._depth = depth
+                if depth == 0:
+                    if con.in_transaction:
+                        con.execute("ROLLBACK")
+                    self._owner = None
+                    self._after.clear()
+                else:
+                    con.execute(f"ROLLBACK TO sp{depth}")
+                    con.execute(f"RELEASE sp{depth}")
+                    del self._after[hooks:]  # хуки откатившегося SAVEPOINT не должны сработать
+                raise
+            self._depth = depth
+            if depth:
+                con.execute(f"RELEASE sp{depth}")
+                return
+            try:
+                con.execute("COMMIT")
+            except BaseException:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                self._after.clear()
+                raise
+            finally:
+                self._owner = None
+            self.commits += 1
+            after, self._after = self._after, []
+            for fn in after:
+                fn()
+
+    def after_commit(self, fn: Callable[[], None]):
+        # вызывается после COMMIT текущей транзакции (или сразу, если её нет)
+        if self._depth and self._owner == threading.get_ident():
+            self._after.append(fn)
+        else:
+            fn()
+
+    @contextmanager
+    def read(self):
+        # внутри своей же транзакции читаем через писателя, чтобы видеть незакоммиченное
+        if self._depth and self._owner == threading.get_ident():
+            yield self._writer
+            return
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            with self._olock:
+                grow = self._opened < self.readers
+                if grow:
+                    self._opened += 1
+            con = self._connect(readonly=True) if grow else self._idle.get()
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    def close(self):
+        with self._wlock:
+            if self._writer is not None:
+                self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._olock:
+            self._opened = 0
+
+
+def from_env(path: str) -> Pool:
+    return Pool(path, readers=int(os.getenv("DB_READERS", "4")))
@@ -0,0 +1,119 @@
+import os, threading, time
+from typing import Dict, Iterable, Optional, Tuple
+
+# таблица лидеров в памяти: дерево Фенвика по очкам активных юзеров.
+# Место = 1 + число юзеров со строго большими очками -> O(log P) без сортировок и COUNT по users.
+# Обновляется после коммита каждой записи очков; полностью перечитывается лениво (первый запрос,
+# импорт) и раз в LEADERBOARD_REFRESH_SEC, если очки пишут и другие процессы (шарды, реплики).
+LEADERBOARD_REFRESH_SEC = float(os.getenv("LEADERBOARD_REFRESH_SEC", "0"))  # 0 -> только свои записи
+
+
+class Leaderboard:
+    def __init__(self, refresh_sec: float = LEADERBOARD_REFRESH_SEC):
+        self.refresh_sec = refresh_sec
+        self._lock = threading.Lock()
+        self._points: Dict[int, int] = {}
+        self._tree = [0] * 1025
+        self._loaded_at = None
+        self._pending = None  # записи, пришедшие во время перечитывания: chat_id -> (только_если_есть, очки)
+
+    def __len__(self):
+        return len(self._points)
+
+    # --- дерево: индекс = очки + 1
+
+    def _add(self, pts: int, n: int):
+        i = pts + 1
+        while i < len(self._tree):
+            self._tree[i] += n
+            i += i & -i
+
+    def _greater(self, pts: int) -> int:
+        i, le = min(pts + 1, len(self._tree) - 1), 0
+        while i:
+            le += self._tree[i]
+            i -= i & -i
+        return len(self._points) - le
+
+    def _rebuild(self, size: int):
+        self._tree = [0] * (size + 1)
+        for p in self._points.values():
+            self._add(p, 1)
+
+    def _set(self, chat_id: int, pts: Optional[int]):
+        old = self._points.pop(chat_id, None)
+        if old is not None:
+            self._add(old, -1)
+        if pts is None:
+            return
+        pts = max(0, int(pts))
+        self._points[chat_id] = pts
+        if pts + 1 >= len(self._tree):
+            self._rebuild(max(2 * len(self._tree), pts + 2))  # дерево растёт вместе с максимумом очков
+        else:
+            self._add(pts, 1)
+
+    # --- запись
+
+    def set(self, chat_id: int, pts: Optional[int]):
+        # юзер активен с такими очками (None -> выбыл)
+        with self._lock:
+            if self._pending is not None:
+                self._pending[chat_id] = (False, pts)
+            self._set(chat_id, pts)
+
+    def update(self, chat_id: int, pts: int):
+        # очки изменились; неактивных в таблице нет — их не добавляем
+        with self._lock:
+            if self._pending is not None:
+                prev = self._pending.get(chat_id)
+                self._pending[chat_id] = (prev[0] if prev else True, pts)
+            if chat_id in self._points:
+                self._set(chat_id, pts)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    # --- перечитывание: begin() -> True, вызывающий читает (chat_id, points) активных и отдаёт в load()
+
+    def stale(self) -> bool:
+        at = self._loaded_at
+        return at is None or (self.refresh_sec > 0 and time.monotonic() - at > self.refresh_sec)
+
+    def begin(self) -> bool:
+        # False: свежо или уже перечитывает другой — отвечаем по текущему состоянию
+        with self._lock:
+            if self._pending is not None or not self.stale():
+                return False
+            self._pending = {}
+            return True
+
+    def load(self, rows: Iterable[Tuple[int, int]]):
+        with self._lock:
+            self._points = {c: max(0, int(p)) for c, p in rows}
+            self._rebuild(max(1024, 2 * max(self._points.values(), default=0)))
+            # записи, закоммиченные во время чтения, новее прочитанного
+            for c, (only_known, p) in self._pending.items():
+                if not only_known or c in self._points:
+                    self._set(c, p)
+            self._pending = None
+            self._loaded_at = time.monotonic()
+
+    def abort(self):
+        with self._lock:
+            self._pending = None
+
+    # --- чтение
+
+    def rank(self, chat_id: int) -> Optional[Tuple[int, int]]:
+        # (место, всего активных); None -> юзера нет среди активных
+        with self._lock:
+            pts = self._points.get(chat_id)
+            if pts is None:
+                return None
+            return self._greater(pts) + 1, len(self._points)
+
+    def ranks(self, points: Iterable[int]) -> Tuple[int, ...]:
+        with self._lock:
+            return tuple(self._greater(max(0, int(p))) + 1 for p in points)
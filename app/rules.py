@@ -0,0 +1,31 @@
+from typing import Dict, Tuple
+
+# правила сдвига целей и очков — общие для всех бэкендов хранилища
+
+
+def next_targets(u, inc: Dict[str, bool]) -> Tuple[float, ...]:
+    # если цель выполнена -> двигаем по дельте, иначе оставляем
+    def step(val, d, ok, end_is_min=False):
+        if ok:
+            newv = val + d
+            return newv
+        return val
+
+    # применяем
+    new_reading = step(u["reading_target"], u["d_reading"], inc["reading"])
+    new_focus   = step(u["focus_target"],   u["d_focus"],   inc["focus"])
+    new_screen  = step(u["screen_target"],  u["d_screen"],  inc["screen"])
+    new_tg      = step(u["tg_target"],      u["d_tg"],      inc["tg"])
+    new_wake    = step(u["wake_target"],    u["d_wake"],    inc["wake"])
+    new_sleep   = step(u["sleep_target"],   u["d_sleep"],   inc["sleep"])
+
+    # гарантии: tg <= screen
+    if new_tg > new_screen:
+        new_tg = new_screen
+    return new_reading, new_focus, new_screen, new_tg, new_wake, new_sleep
+
+
+def next_points(u, delta_pts: int, success_all: bool, any_fail: bool) -> Tuple[int, int]:
+    pts = max(0, u["points"] + delta_pts + (50 if success_all else 0))
+    streak = u["streak"] + 1 if not any_fail else 0
+    return pts, streak
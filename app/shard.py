@@ -0,0 +1,219 @@
+import argparse, asyncio, json, logging, os, signal, sys
+from typing import Dict, List, Optional
+
+from app.httpd import HttpServer
+
+log = logging.getLogger(__name__)
+
+# несколько воркеров app.bot на одном хосте, каждый владеет шардом юзеров по chat_id.
+#   python -m app.shard --workers 4
+# Фронт принимает вебхук Telegram и пересылает апдейт воркеру его шарда (порядок чата не ломается,
+# кэши опросов и юзеров остаются локальными). Рассылки шарда шлёт только владелец его file-lock;
+# шарды упавших воркеров на время подхватывает лидер (тоже file-lock). Внешних сервисов не нужно.
+SHARD_DIR = os.getenv("SHARD_DIR", os.path.join(os.path.dirname(os.getenv("DB_PATH", "data/bot.db")) or ".", "shards"))
+SHARD_RESTART_SEC = float(os.getenv("SHARD_RESTART_SEC", "2"))
+
+
+def shard_of(chat_id: int, n: int) -> int:
+    # то же выражение, что в SQL (app.db.iter_active_users): отрицательные id групп -> в [0, n)
+    return chat_id % n
+
+
+def parse_shard(spec: str):
+    # "2/4" -> (2, 4)
+    i, _, n = spec.partition("/")
+    i, n = int(i), int(n)
+    if not 0 <= i < n:
+        raise ValueError(f"bad shard {spec!r}")
+    return i, n
+
+
+class Shards:
+    # какие шарды этот процесс сейчас может рассылать. Блокировки — flock на файлах в SHARD_DIR:
+    # ядро снимает их само, когда процесс умирает, так что «владелец жив» == «файл заперт»
+    def __init__(self, index: int = 0, count: int = 1, lock_dir: str = SHARD_DIR):
+        self.index = index
+        self.count = count
+        self.lock_dir = lock_dir
+        self._held: Dict[str, int] = {}
+        self._adopted: List[int] = []
+        # свой шард был не у нас (старт, тик проигран лидеру): он мог начать опросы шарда,
+        # которых нет в нашем кэше. Сбрасывает бот, перечитав таблицу survey
+        self.lapsed = True
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    def mine(self, chat_id: int) -> bool:
+        return shard_of(chat_id, self.count) == self.index
+
+    def _lock(self, name: str) -> bool:
+        if name in self._held:
+            return True
+        import fcntl
+        os.makedirs(self.lock_dir, exist_ok=True)
+        fd = os.open(os.path.join(self.lock_dir, name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._held[name] = fd
+        return True
+
+    def _unlock(self, name: str):
+        fd = self._held.pop(name, None)
+        if fd is not None:
+            os.close(fd)  # закрытие снимает flock
+
+    @property
+    def leader(self) -> bool:
+        return "leader.lock" in self._held
+
+    def acquire(self) -> List[int]:
+        # зовётся на каждом тике: свой шард держим постоянно, лидерство — пока живы,
+        # чужой шард лидер берёт только если его файл никто не держит (воркер упал)
+        if not self.enabled:
+            return [0]
+        self.release_adopted()
+        owned = [self.index] if self._lock(f"shard-{self.index}.lock") else []
+        if not owned:
+            self.lapsed = True
+        if self._lock("leader.lock"):
+            for i in range(self.count):
+                if i != self.index and self._lock(f"shard-{i}.lock"):
+                    self._adopted.append(i)
+                    log.warning("leader adopted orphan shard %s/%s", i, self.count)
+        return sorted(owned + self._adopted)
+
+    def release_adopted(self):
+        # чужие шарды держим только на время решения тика, чтобы вернувшийся владелец их забрал
+        for i in self._adopted:
+            self._unlock(f"shard-{i}.lock")
+        self._adopted.clear()
+
+    def close(self):
+        for name in list(self._held):
+            self._unlock(name)
+        self._adopted.clear()
+
+
+def chat_of(update: dict) -> Optional[int]:
+    # chat.id (или from.id) из сырого апдейта, без разбора в telegram.Update
+    for key, v in update.items():
+        if key == "update_id" or not isinstance(v, dict):
+            continue
+        for holder in (v, v.get("message")):
+            if isinstance(holder, dict) and isinstance(holder.get("chat"), dict):
+                return holder["chat"].get("id")
+        if isinstance(v.get("from"), dict):
+            return v["from"].get("id")
+    return None
+
+
+async def forward(host: str, port: int, path: str, body: bytes, headers: Dict[str, str]) -> int:
+    # POST на локальный воркер; короткое соединение — по loopback это дешевле, чем пул
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        head = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n"
+                      f"Connection: close\r\n{head}\r\n").encode("latin-1") + body)
+        await writer.drain()
+        status = await reader.readline()
+        await reader.read()
+        return int(status.split()[1])
+    finally:
+        writer.close()
+
+
+class Front:
+    # публичный вебхук: раскидывает апдейты по воркерам и перезапускает упавших
+    def __init__(self, workers: int, host: str, port: int, path: str, secret: str, url: str):
+        self.workers = workers
+        self.path = path
+        self.secret = secret
+        self.url = url
+        self.server = HttpServer(host, port)
+        self.server.route("POST", path, self._handle)
+        self.server.route("GET", "/healthz", self._health)
+        self._procs: Dict[int, asyncio.subprocess.Process] = {}
+        self._stopping = False
+
+    def worker_port(self, i: int) -> int:
+        return self.server.port + 1 + i
+
+    async def _handle(self, headers, body):
+        try:
+            chat_id = chat_of(json.loads(body))
+        except (ValueError, AttributeError):
+            return 400, b"", "text/plain"
+        i = shard_of(chat_id, self.workers) if chat_id is not None else 0
+        fwd = {"Content-Type": "application/json"}
+        if "x-telegram-bot-api-secret-token" in headers:
+            fwd["X-Telegram-Bot-Api-Secret-Token"] = headers["x-telegram-bot-api-secret-token"]
+        try:
+            status = await forward("127.0.0.1", self.worker_port(i), self.path, body, fwd)
+        except OSError:
+            # воркер перезапускается -> Telegram повторит апдейт сам
+            return 500, b"", "text/plain"
+        return status, b"", "text/plain"
+
+    async def _health(self, headers, body):
+        alive = sum(p.returncode is None for p in self._procs.values())
+        return (200 if alive == self.workers else 500), f"{alive}/{self.workers}", "text/plain"
+
+    async def _run_worker(self, i: int):
+        env = dict(os.environ, PORT=str(self.worker_port(i)), WEBHOOK_HOST="127.0.0.1",
+                   WEBHOOK_PATH=self.path, WEBHOOK_SECRET=self.secret,
+                   # setWebhook на публичный адрес фронта ставит только нулевой воркер
+                   WEBHOOK_URL=self.url if i == 0 else "",
+                   # очки чужих шардов пишут другие процессы -> таблицу лидеров иногда перечитываем
+                   LEADERBOARD_REFRESH_SEC=os.getenv("LEADERBOARD_REFRESH_SEC", "60"))
+        if os.getenv("METRICS_PORT", "9108"):
+            env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT", "9108")) + i)  # у каждого воркера свой
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "app.bot", "--webhook", "--shard", f"{i}/{self.workers}", env=env)
+            self._procs[i] = proc
+            code = await proc.wait()
+            if not self._stopping:
+                log.error("worker %s exited with %s, restarting", i, code)
+                await asyncio.sleep(SHARD_RESTART_SEC)
+
+    async def run(self):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        await self.server.start()
+        tasks = [asyncio.create_task(self._run_worker(i)) for i in range(self.workers)]
+        log.info("front on %s:%s -> %s workers", self.server.host, self.server.port, self.workers)
+        try:
+            await stop.wait()
+        finally:
+            self._stopping = True
+            await self.server.stop()
+            for p in self._procs.values():
+                if p.returncode is None:
+                    p.send_signal(signal.SIGTERM)
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main(argv=None):
+    from app.webhook import WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL, require_secret
+    p = argparse.ArgumentParser(prog="app.shard")
+    p.add_argument("--workers", type=int, default=int(os.getenv("SHARDS", "2")))
+    p.add_argument("--port", type=int, default=WEBHOOK_PORT, help="порт фронта; воркеры — port+1..port+N")
+    args = p.parse_args(argv)
+    require_secret(WEBHOOK_URL, WEBHOOK_SECRET)  # фронт слушает публичный порт
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    front = Front(args.workers, WEBHOOK_HOST, args.port, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL)
+    asyncio.run(front.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import zoneinfo
+from collections import defaultdict
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+from app.config import DEFAULT_TZ
+
+
+@lru_cache(maxsize=None)
+def zone(name: str) -> zoneinfo.ZoneInfo:
+    # кривой tz в базе не должен ронять рассылку -> дефолтная зона
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError, TypeError):
+        return zoneinfo.ZoneInfo(DEFAULT_TZ)
+
+
+def local_today(tz_name: str) -> date:
+    return datetime.now(zone(tz_name)).date()
+
+
+def slot_instant(d: date, hh: int, mm: int, tz: zoneinfo.ZoneInfo) -> datetime:
+    # локальное время слота -> момент (aware). Несуществующее (весенний перевод)
+    # и двойное (осенний) время дают ровно один момент на локальную дату (fold=0)
+    return datetime.combine(d, time(hh, mm), tzinfo=tz)
+
+
+def due_zones(zones: Iterable[str], hh: int, mm: int,
+              prev: datetime, now: datetime) -> Dict[Tuple[date, timedelta], List[str]]:
+    # какие зоны прошли слот hh:mm в окне (prev, now]; группируем по (локальная дата, UTC-смещение)
+    groups = defaultdict(list)
+    for name in zones:
+        tz = zone(name)
+        today = now.astimezone(tz).date()
+        for d in (today - timedelta(days=1), today):
+            at = slot_instant(d, hh, mm, tz)
+            if prev < at <= now:
+                groups[(d, at.utcoffset())].append(name)
+    return dict(groups)
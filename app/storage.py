@@ -0,0 +1,77 @@
+import os
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Protocol, Sequence, Tuple
+
+# контракт хранилища для бота: всё async. SQLite (app.db через AsyncStore) — по умолчанию,
+# PostgreSQL (app.pg.PgStore) — если задан DATABASE_URL. Строки — любые Mapping (r["col"]).
+Row = Mapping[str, Any]
+
+
+class Store(Protocol):
+    async def init_db(self) -> None: ...
+    async def close(self) -> None: ...
+    def cache_stats(self) -> Dict[str, Any]: ...
+
+    async def upsert_user(self, chat_id: int, tz: str, targets: Dict[str, float],
+                          deltas: Dict[str, float], start_date: str) -> None: ...
+    async def get_user(self, chat_id: int) -> Optional[Row]: ...
+    async def all_active_users(self) -> List[Row]: ...
+    def iter_active_users(self, batch_size: int = 500, columns: Sequence[str] = ("chat_id",),
+                          tzs: Optional[Sequence[str]] = None,
+                          shard: Optional[Tuple[Sequence[int], int]] = None) -> AsyncIterator[List[Row]]: ...
+    async def active_zones(self) -> List[str]: ...
+    async def set_tz(self, chat_id: int, tz: str) -> None: ...
+    async def set_active(self, chat_id: int, active: int) -> None: ...
+
+    async def update_targets_after_day(self, chat_id: int, inc: Dict[str, bool], d: str) -> None: ...
+    async def advance_targets(self, d: str) -> int: ...
+    async def add_points_and_streak(self, chat_id: int, delta_pts: int, success_all: bool,
+                                    any_fail: bool) -> Optional[Tuple[int, int]]: ...
+    async def finalize_day(self, chat_id: int, d: str, done: Dict[str, int], flags: Dict[str, bool],
+                           delta: int) -> Optional[Tuple[int, int]]: ...
+
+    # таблица лидеров: место — из памяти (app.ranks), топ — по индексу на points
+    async def refresh_ranks(self) -> int: ...
+    async def user_rank(self, chat_id: int) -> Optional[Tuple[int, int]]: ...
+    async def top_users(self, limit: int = 10) -> List[Row]: ...
+
+    async def upsert_log(self, chat_id: int, d: str, **vals) -> None: ...
+    async def get_range_stats(self, chat_id: int, d_from: str, d_to: str) -> Dict[str, Any]: ...
+    async def get_week_stats(self, chat_id: int, d_from: str, d_to: str) -> Dict[str, Any]: ...
+
+    async def put_survey_state(self, chat_id: int, step: int, d: str) -> None: ...
+    async def start_surveys(self, chat_ids: List[int], d: str) -> None: ...
+    async def get_survey_state(self, chat_id: int) -> Optional[Row]: ...
+    async def set_survey_value(self, chat_id: int, field: str, value: int, next_step: int) -> None: ...
+    async def load_surveys(self) -> List[Row]: ...
+    async def save_surveys(self, rows: List[Tuple]) -> None: ...
+    async def clear_survey(self, chat_id: int) -> None: ...
+    async def claim_slot(self, job: str, d: str, utc_offset: int, shard: int) -> bool: ...
+
+    def iter_rows(self, table: str, batch_size: int = 5000,
+                  chat_id: Optional[int] = None) -> AsyncIterator[List[Row]]: ...
+    async def import_rows(self, table: str, columns: Sequence[str], rows: Sequence[Sequence]) -> int: ...
+
+
+# допустимые имена колонок для динамических запросов (iter_active_users, upsert_log)
+USER_COLS = (
+    "chat_id", "tz", "active", "start_date", "day_index",
+    "reading_target", "focus_target", "screen_target", "tg_target", "wake_target", "sleep_target",
+    "d_reading", "d_focus", "d_screen", "d_tg", "d_wake", "d_sleep",
+    "points", "streak",
+)
+
+LOG_COLS = ("reading_done", "focus_done", "screen_done", "tg_done", "wake_actual", "sleep_actual",
+            "ok_reading", "ok_focus", "ok_screen", "ok_tg", "ok_wake", "ok_sleep")
+
+# что выгружает/загружает app.export: колонки таблиц в порядке файла
+EXPORT_COLS = {"users": USER_COLS, "logs": ("chat_id", "d", *LOG_COLS)}
+
+
+def open_store(url: str = None) -> Store:
+    url = url if url is not None else os.getenv("DATABASE_URL", "")
+    if url.startswith(("postgres://", "postgresql://")):
+        from app.pg import PgStore
+        return PgStore(url)
+    from app import db
+    from app.astore import AsyncStore
+    return AsyncStore(db)
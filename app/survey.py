@@ -0,0 +1,79 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+FIELDS = ("tmp_reading", "tmp_focus", "tmp_screen", "tmp_tg", "tmp_wake", "tmp_sleep")
+
+
+class Survey:
+    __slots__ = ("chat_id", "step", "d") + FIELDS
+
+    def __init__(self, chat_id: int, step: int, d: str, *tmp):
+        self.chat_id = chat_id
+        self.step = step
+        self.d = d
+        for f, v in zip(FIELDS, tmp or (None,) * len(FIELDS)):
+            setattr(self, f, v)
+
+    # как sqlite3.Row: s["step"]
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def row(self) -> Tuple:
+        # d в конце: flush, взявший строки до start_surveys следующего вечера, не затрёт новый опрос
+        return (self.step, *(getattr(self, f) for f in FIELDS), self.chat_id, self.d)
+
+
+class SurveyCache:
+    # в памяти только чаты с активным опросом; таблица survey догоняет асинхронно (write-behind)
+    def __init__(self):
+        self._active: Dict[int, Survey] = {}
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._active)
+
+    def __contains__(self, chat_id: int):
+        return chat_id in self._active
+
+    def load(self, rows: Iterable) -> List[Survey]:
+        # после рестарта: состояние из таблицы survey (последний flush). Грузится в фоне, пока бот
+        # уже принимает апдейты, -> опросы, начатые за это время, свежее таблицы и не затираются.
+        # -> поднятые из таблицы (их шаг может отставать от уже заданного вопроса)
+        restored = []
+        for r in rows:
+            if r["chat_id"] not in self._active:
+                s = self._active[r["chat_id"]] = Survey(r["chat_id"], r["step"], r["d"], *(r[f] for f in FIELDS))
+                restored.append(s)
+        return restored
+
+    def get(self, chat_id: int) -> Optional[Survey]:
+        return self._active.get(chat_id)
+
+    def start(self, chat_ids: Iterable[int], d: str):
+        # строки в БД уже созданы вечерним тиком, здесь только память
+        for chat_id in chat_ids:
+            self._active[chat_id] = Survey(chat_id, 0, d)
+            self._dirty.discard(chat_id)
+
+    def answer(self, chat_id: int, field: str, value: int, next_step: int, persist: bool = True):
+        # persist=False (кнопки): шаги только в памяти, в БД опрос попадёт целиком в finalize_day
+        s = self._active[chat_id]
+        setattr(s, field, value)
+        s.step = next_step
+        if persist:
+            self._dirty.add(chat_id)
+
+    def drop(self, chat_id: int):
+        self._active.pop(chat_id, None)
+        self._dirty.discard(chat_id)
+
+    def take_dirty(self) -> List[Tuple]:
+        rows = [self._active[c].row() for c in self._dirty if c in self._active]
+        self._dirty.clear()
+        return rows
+
+    def mark_dirty(self, rows: List[Tuple]):
+        # flush не удался -> вернуть в очередь (если опрос ещё жив)
+        for r in rows:
+            s = self._active.get(r[-2])
+            if s is not None and s.d == r[-1]:
+                self._dirty.add(r[-2])
@@ -0,0 +1,150 @@
+import argparse, asyncio, hmac, json, logging, os, signal, time
+import urllib.request
+
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+from app.httpd import HttpServer
+
+log = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен при WEBHOOK_URL
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес; пусто -> setWebhook не зовём (офлайн)
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    # апдейты разных чатов обрабатываются параллельно, одного чата — строго по очереди
+    # (иначе два ответа на опрос могут прочитать один и тот же step)
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        entry = self._locks.get(chat.id)
+        if entry is None:
+            entry = self._locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def webhook_server(app: Application, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                   path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> HttpServer:
+    server = HttpServer(host, port)
+
+    async def handle(headers, body):
+        if secret and not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), secret):
+            return 403, b"", "text/plain"
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, b"", "text/plain"
+        # отвечаем Telegram сразу, обработка идёт в фоне (concurrent_updates)
+        await app.update_queue.put(update)
+        return 200, b"", "text/plain"
+
+    async def health(headers, body):
+        return 200, b"ok", "text/plain"
+
+    server.route("POST", path, handle)
+    server.route("GET", "/healthz", health)
+    return server
+
+
+def require_secret(url: str, secret: str):
+    # без секрета любой, кто угадал путь, шлёт боту апдейты от чужого имени; офлайн (без url) — можно
+    if url and not secret:
+        raise SystemExit("WEBHOOK_URL задан, а WEBHOOK_SECRET пуст: публичный вебхук без секрета не поднимаем")
+
+
+async def serve(app: Application, server: HttpServer, path: str = WEBHOOK_PATH,
+                url: str = WEBHOOK_URL, secret: str = WEBHOOK_SECRET):
+    # тот же жизненный цикл, что у run_polling, только апдейты приходят POST-ом
+    require_secret(url, secret)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    await server.start()
+    if url:
+        await app.bot.set_webhook(url=url.rstrip("/") + path, secret_token=secret,
+                                  allowed_updates=Update.ALL_TYPES, max_connections=100)
+    log.info("webhook listening on %s:%s", server.host, server.port)
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def fake_update(chat_id: int, text: str, update_id: int = None) -> dict:
+    # минимальный апдейт в формате Bot API — для локальной проверки без Telegram
+    now = int(time.time())
+    uid = update_id if update_id is not None else now * 1000 + chat_id % 1000
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else None
+    msg = {"message_id": uid, "date": now, "text": text,
+           "chat": {"id": chat_id, "type": "private"},
+           "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}}
+    if entities:
+        msg["entities"] = entities
+    return {"update_id": uid, "message": msg}
+
+
+def fake_callback(chat_id: int, data: str, message_id: int, update_id: int) -> dict:
+    # нажатие инлайн-кнопки под сообщением бота message_id
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    msg = {"message_id": message_id, "date": int(time.time()), "text": "",
+           "chat": {"id": chat_id, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "bot"}}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user, "message": msg,
+                                                       "chat_instance": str(chat_id), "data": data}}
+
+
+def post_update(url: str, payload: dict, secret: str = WEBHOOK_SECRET) -> int:
+    req = urllib.request.Request(url, data=json.dumps(payload).encode(), method="POST",
+                                 headers={"Content-Type": "application/json"})
+    if secret:
+        req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    with urllib.request.urlopen(req) as resp:
+        return resp.status
+
+
+if __name__ == "__main__":
+    # python -m app.webhook --chat 1 --text /start  -> шлёт фейковый апдейт в локальный вебхук
+    p = argparse.ArgumentParser()
+    p.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    p.add_argument("--chat", type=int, required=True)
+    p.add_argument("--text", required=True)
+    args = p.parse_args()
+    print(post_update(args.url, fake_update(args.chat, args.text)))